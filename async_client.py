@@ -0,0 +1,439 @@
+# encoding: utf-8
+# Cliente HFTP para asyncio, con un pool de conexiones reusables.
+
+import asyncio
+import contextlib
+import logging
+import os
+import time
+from constants import *
+from framing import FragmentDecoder, LineBuffer
+
+
+class AsyncClient(object):
+    """
+    Una conexión HFTP para usar desde asyncio. Ofrece los mismos comandos
+    que client.Client, como corrutinas.
+
+    Se crea con `await AsyncClient.connect(server, port)'.
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.buffer = LineBuffer()
+        self.connected = True
+        self.status = None
+        self.mode = 'base64'  # modo de transferencia de get_slice
+
+    @classmethod
+    async def connect(cls, server=DEFAULT_ADDR, port=DEFAULT_PORT):
+        """
+        Abre una conexión nueva. Si falla, genera una excepción OSError.
+        """
+        reader, writer = await asyncio.open_connection(server, port)
+        return cls(reader, writer)
+
+    async def close(self):
+        """
+        Manda quit y cierra la conexión.
+        """
+        if self.connected:
+            try:
+                await self.send('quit')
+                self.status, message = await self.read_response_line()
+                if self.status != CODE_OK:
+                    logging.warning("Warning: quit no contesto ok, sino "
+                                    "'%s'(%s)'." % (message, self.status))
+            except OSError:
+                pass
+        self.abort()
+
+    def abort(self):
+        """
+        Cierra la conexión sin avisar al server.
+        """
+        self.connected = False
+        self.writer.close()
+
+    async def send(self, message):
+        """
+        Envía el mensaje 'message' al server, seguido por el terminador de
+        línea del protocolo.
+        """
+        self.writer.write((message + EOL).encode("ascii"))
+        await self.writer.drain()
+
+    async def _recv(self):
+        data = await self.reader.read(RECV_SIZE)
+        self.buffer.feed(data)
+        if len(data) == 0:
+            logging.info("El server interrumpió la conexión.")
+            self.connected = False
+
+    async def read_line(self):
+        """
+        Espera una línea completa y la devuelve sin el terminador ni los
+        espacios en blanco al principio y al final. Si el server corta,
+        devuelve "".
+        """
+        response = self.buffer.next_line()
+        while response is None and self.connected:
+            await self._recv()
+            response = self.buffer.next_line()
+        if response is None:
+            self.connected = False
+            return ""
+        return response.decode("ascii").strip()
+
+    async def read_response_line(self):
+        """
+        Espera y parsea una línea de respuesta de un comando.
+
+        Devuelve un par (int, str) con el código y el error, o
+        (None, None) en caso de error.
+        """
+        response = await self.read_line()
+        if ' ' in response:
+            code, message = response.split(None, 1)
+            try:
+                return int(code), message
+            except ValueError:
+                pass
+        else:
+            logging.warning("Respuesta inválida: '%s'" % response)
+        return None, None
+
+    async def read_fragment_into(self, length, write):
+        """
+        Lee un fragmento de `length' bytes a medida que llega, pasando los
+        datos decodificados de a partes a write(bytes).
+
+        Devuelve la cantidad de bytes decodificados.
+        """
+        decoder = FragmentDecoder(self.mode, length)
+        while True:
+            for piece in decoder.consume(self.buffer):
+                write(piece)
+            if decoder.done or not self.connected:
+                return decoder.received
+            await self._recv()
+
+    async def set_mode(self, mode):
+        """
+        Elige el modo de transferencia de get_slice ('base64', 'binary' o
+        'zlib'). Devuelve True si el server lo aceptó.
+        """
+        await self.send('set_mode %s' % mode)
+        self.status, message = await self.read_response_line()
+        if self.status == CODE_OK:
+            self.mode = mode
+            return True
+        logging.warning("El servidor no aceptó el modo %s (code=%s %s)."
+                        % (mode, self.status, message))
+        return False
+
+    async def file_lookup(self):
+        """
+        Obtener el listado de archivos en el server. Devuelve una lista
+        de strings.
+        """
+        result = []
+        await self.send('get_file_listing')
+        self.status, message = await self.read_response_line()
+        if self.status == CODE_OK:
+            filename = await self.read_line()
+            while filename:
+                result.append(filename)
+                filename = await self.read_line()
+        else:
+            logging.warning("Falló la solicitud de la lista de archivos" +
+                            "(code=%s %s)." % (self.status, message))
+        return result
+
+    async def get_metadata(self, filename):
+        """
+        Obtiene en el server el tamaño del archivo con el nombre dado.
+        Devuelve None en caso de error.
+        """
+        await self.send('get_metadata %s' % filename)
+        self.status, message = await self.read_response_line()
+        if self.status == CODE_OK:
+            return int(await self.read_line())
+
+    async def fetch_slice(self, filename, start, length, write):
+        """
+        Pide un trozo de un archivo y pasa sus datos a write(bytes) a medida
+        que llegan. Devuelve la cantidad de bytes recibidos, o None si el
+        server indicó un error.
+        """
+        await self.send('get_slice %s %d %d' % (filename, start, length))
+        self.status, message = await self.read_response_line()
+        if self.status == CODE_OK:
+            return await self.read_fragment_into(length, write)
+        logging.warning("El servidor indico un error al leer de %s."
+                        % filename)
+        return None
+
+    async def get_slice(self, filename, start, length):
+        """
+        Obtiene un trozo de un archivo en el server y lo guarda localmente,
+        en el directorio actual, con el mismo nombre que tiene en el server.
+        Devuelve la cantidad de bytes recibidos, o None en caso de error.
+        """
+        output = None
+
+        def write(data):
+            nonlocal output
+            if output is None:
+                output = open(filename, 'wb')
+            output.write(data)
+
+        try:
+            received = await self.fetch_slice(filename, start, length, write)
+            if received is not None and output is None:
+                output = open(filename, 'wb')  # slice vacío
+        finally:
+            if output is not None:
+                output.close()
+        return received
+
+    async def read_slice(self, filename, start, length):
+        """
+        Obtiene un trozo de un archivo en el server y lo devuelve, sin
+        guardarlo. Devuelve None en caso de error.
+        """
+        fragment = bytearray()
+        if await self.fetch_slice(filename, start, length,
+                                  fragment.extend) is None:
+            return None
+        return bytes(fragment)
+
+    async def retrieve(self, filename):
+        """
+        Obtiene un archivo completo desde el servidor y lo guarda con el
+        mismo nombre en el directorio actual. Devuelve el tamaño, o None si
+        no se pudo obtener.
+        """
+        size = await self.get_metadata(filename)
+        if self.status == CODE_OK:
+            return await self.get_slice(filename, 0, size)
+        elif self.status == FILE_NOT_FOUND:
+            logging.info("El archivo solicitado no existe.")
+        else:
+            logging.warning("No se pudo obtener el archivo %s (code=%s)."
+                            % (filename, self.status))
+        return None
+
+    async def ping(self):
+        """
+        Verifica que la conexión siga respondiendo, volviendo a elegir su
+        modo de transferencia: es un pedido válido que no cambia nada, y
+        de paso confirma que la conexión sigue en el modo esperado.
+        """
+        try:
+            await self.send('set_mode %s' % self.mode)
+            self.status, message = await self.read_response_line()
+        except OSError:
+            self.connected = False
+        return self.connected and self.status == CODE_OK
+
+
+class ClientPool(object):
+    """
+    Pool de hasta max_size conexiones a un server, para compartir entre
+    muchas tareas de asyncio sin abrir una conexión por pedido.
+
+    Las conexiones se piden con `async with pool.connection() as c'. Al
+    devolverlas vuelven a la lista de libres, salvo que el server las haya
+    cortado o el pedido se haya interrumpido a la mitad (la respuesta
+    quedaría mezclada con la del próximo). Las libres se cierran tras
+    idle_timeout segundos sin uso, aunque no se vuelva a usar el pool, y
+    las que estuvieron libres más de check_after segundos se verifican con
+    un ping antes de reusarlas.
+
+    Parámetros:
+        server, port: dirección del server.
+        max_size: máximo de conexiones abiertas a la vez.
+        mode: modo de transferencia ('base64', 'binary' o 'zlib') de las
+            conexiones.
+        idle_timeout, check_after: en segundos, ver arriba.
+    """
+
+    def __init__(self, server=DEFAULT_ADDR, port=DEFAULT_PORT,
+                 max_size=DEFAULT_POOL_SIZE, mode='base64',
+                 idle_timeout=POOL_IDLE_TIMEOUT,
+                 check_after=POOL_CHECK_AFTER):
+        self.server = server
+        self.port = port
+        self.mode = mode
+        self.idle_timeout = idle_timeout
+        self.check_after = check_after
+        self.slots = asyncio.Semaphore(max_size)
+        self.idle = []  # pares (cuándo se liberó, conexión), LIFO
+        self.expiry = None  # asyncio.TimerHandle del próximo _expire
+        self.closed = False
+
+    async def acquire(self):
+        """
+        Devuelve una conexión lista para usar, esperando si ya hay max_size
+        en uso. Debe devolverse con release.
+        """
+        if self.closed:
+            raise RuntimeError("El pool está cerrado")
+        await self.slots.acquire()
+        try:
+            client = await self._reuse()
+            if client is None:
+                client = await AsyncClient.connect(self.server, self.port)
+                if self.mode != client.mode and \
+                        not await client.set_mode(self.mode):
+                    client.abort()
+                    raise ValueError("Modo no soportado: %s" % self.mode)
+            return client
+        except BaseException:
+            self.slots.release()
+            raise
+
+    async def _reuse(self):
+        self._expire()
+        while self.idle:
+            released, client = self.idle.pop()
+            if time.monotonic() - released < self.check_after or \
+                    await client.ping():
+                return client
+            client.abort()
+        return None
+
+    def _expire(self):
+        now = time.monotonic()
+        keep = []
+        for released, client in self.idle:
+            if now - released < self.idle_timeout:
+                keep.append((released, client))
+            else:
+                client.abort()
+        self.idle = keep
+
+    def _schedule_expiry(self):
+        """
+        Programa en el event loop el cierre de las conexiones libres para
+        cuando venza la más vieja (la primera de self.idle).
+        """
+        if self.expiry is None and self.idle:
+            delay = self.idle[0][0] + self.idle_timeout - time.monotonic()
+            self.expiry = asyncio.get_running_loop().call_later(
+                max(delay, 0), self._on_expiry)
+
+    def _on_expiry(self):
+        self.expiry = None
+        self._expire()
+        self._schedule_expiry()
+
+    def release(self, client, reusable=True):
+        """
+        Devuelve una conexión obtenida con acquire. Si reusable es False, o
+        la conexión se cortó, se cierra en lugar de guardarse.
+        """
+        if reusable and client.connected and not self.closed:
+            self.idle.append((time.monotonic(), client))
+            self._schedule_expiry()
+        else:
+            client.abort()
+        self.slots.release()
+
+    @contextlib.asynccontextmanager
+    async def connection(self):
+        """
+        Context manager asincrónico que presta una conexión del pool.
+        """
+        client = await self.acquire()
+        try:
+            yield client
+        except BaseException:
+            self.release(client, reusable=False)
+            raise
+        self.release(client)
+
+    async def close(self):
+        """
+        Cierra las conexiones libres; las que están en uso se cierran al
+        devolverse.
+        """
+        self.closed = True
+        if self.expiry is not None:
+            self.expiry.cancel()
+            self.expiry = None
+        idle, self.idle = self.idle, []
+        await asyncio.gather(*(client.close() for _, client in idle))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def file_lookup(self):
+        async with self.connection() as client:
+            return await client.file_lookup()
+
+    async def get_metadata(self, filename):
+        async with self.connection() as client:
+            return await client.get_metadata(filename)
+
+    async def get_slice(self, filename, start, length):
+        async with self.connection() as client:
+            return await client.get_slice(filename, start, length)
+
+    async def read_slice(self, filename, start, length):
+        async with self.connection() as client:
+            return await client.read_slice(filename, start, length)
+
+    async def retrieve(self, filename, output=None,
+                       chunk_size=DOWNLOAD_CHUNK_SIZE):
+        """
+        Baja el archivo completo a `output' (por defecto, el mismo nombre en
+        el directorio actual), pidiendo sus pedazos en paralelo por las
+        conexiones del pool. Devuelve el tamaño, o None si no existe.
+        """
+        size = await self.get_metadata(filename)
+        if size is None:
+            logging.info("El archivo solicitado no existe.")
+            return None
+        fd = os.open(output or filename,
+                     os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            os.ftruncate(fd, size)
+
+            async def fetch(start):
+                position = start
+                length = min(chunk_size, size - start)
+
+                def write(data):
+                    nonlocal position
+                    view = memoryview(data)
+                    while view:
+                        written = os.pwrite(fd, view, position)
+                        position += written
+                        view = view[written:]
+
+                async with self.connection() as client:
+                    received = await client.fetch_slice(filename, start,
+                                                        length, write)
+                if received != length:
+                    raise IOError("Falló la descarga de %s en %d"
+                                  % (filename, start))
+
+            tasks = [asyncio.ensure_future(fetch(start))
+                     for start in range(0, size, chunk_size)]
+            try:
+                await asyncio.gather(*tasks)
+            except BaseException:
+                # Que ninguna tarea siga escribiendo en fd una vez cerrado
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+        finally:
+            os.close(fd)
+        return size
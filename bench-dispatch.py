@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Microbenchmark del despacho de comandos: mide el costo por pedido de
+Connection.which_command (registro COMMANDS y líneas de estado ya
+codificadas) y lo compara con la cadena de if/elif anterior, que llamaba a
+lower() en cada rama y armaba y codificaba la línea de estado en cada
+respuesta.
+
+Las respuestas no se envían: la cola de salida se descarta después de
+cada pedido, así que se mide sólo el despacho y la atención del comando
+(que es la misma en ambos casos). Se informa la mejor de varias
+mediciones, en nanosegundos por pedido.
+
+Uso: python bench-dispatch.py [-n 50000] [-r 5]
+"""
+
+import optparse
+import os
+import shutil
+import socket
+import tempfile
+import time
+
+import connection
+from constants import *
+from metrics import REGISTRY as metrics
+
+LEGACY_NAMES = ("quit", "get_file_listing", "get_metadata", "get_slice",
+                "set_mode")
+
+# (descripción, línea del pedido)
+CASES = [
+    ("get_metadata", "get_metadata file"),
+    ("get_metadata (no existe)", "get_metadata missing"),
+    ("get_slice", "get_slice file 0 12"),
+    ("get_file_listing", "get_file_listing"),
+    ("set_mode", "set_mode base64"),
+    ("argumentos inválidos", "get_slice file 0 x"),
+    ("comando inválido", "frobnicate file"),
+]
+
+
+def legacy_dispatch(conn, data_line):
+    """
+    Connection.which_command anterior, con las mismas métricas.
+    """
+    started = time.perf_counter()
+    if conn.request_started is None:
+        conn.request_started = time.monotonic()
+    command, *args = data_line.split(" ")
+    name = command.lower() if command.lower() in LEGACY_NAMES else "invalid"
+    try:
+        legacy_chain(conn, command, args)
+    except Exception:
+        conn.send(f"{INTERNAL_ERROR} {error_messages[INTERNAL_ERROR]}")
+    labels = (("command", name),)
+    metrics.inc("hftp_requests_total", labels=labels)
+    metrics.observe("hftp_request_duration_seconds",
+                    time.perf_counter() - started, labels)
+
+
+def legacy_chain(conn, command, args):
+    if command.lower() == "quit":
+        if len(args) == 0:
+            conn.quit()
+        else:
+            conn.send(f"{INVALID_ARGUMENTS} {error_messages[INVALID_ARGUMENTS]}")
+    elif command.lower() == "get_file_listing":
+        if len(args) == 0:
+            conn.get_file_listing()
+        else:
+            conn.send(f"{INVALID_ARGUMENTS} {error_messages[INVALID_ARGUMENTS]}")
+    elif command.lower() == "get_metadata":
+        if len(args) == 1:
+            conn.get_metadata(args[0])
+        else:
+            conn.send(f"{INVALID_ARGUMENTS} {error_messages[INVALID_ARGUMENTS]}")
+    elif command.lower() == "get_slice":
+        try:
+            if len(args) == 3:
+                conn.get_slice(args[0], int(args[1]), int(args[2]))
+            else:
+                conn.send(f"{INVALID_ARGUMENTS} {error_messages[INVALID_ARGUMENTS]}")
+        except ValueError:
+            conn.send(f"{INVALID_ARGUMENTS} {error_messages[INVALID_ARGUMENTS]}")
+    elif command.lower() == "set_mode":
+        if len(args) == 1 and args[0] in TRANSFER_MODES:
+            conn.set_mode(args[0])
+        else:
+            conn.send(f"{INVALID_ARGUMENTS} {error_messages[INVALID_ARGUMENTS]}")
+    else:
+        conn.send(f"{INVALID_COMMAND} {error_messages[INVALID_COMMAND]}")
+
+
+def measure(dispatch, conn, line, count):
+    start = time.perf_counter()
+    for _ in range(count):
+        dispatch(line)
+        conn.outgoing.clear()
+    return (time.perf_counter() - start) / count
+
+
+def best(dispatch, conn, line, count, repeat):
+    return min(measure(dispatch, conn, line, count) for _ in range(repeat))
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("-n", "--count", type="int", default=50000,
+                      help="Pedidos por medición")
+    parser.add_option("-r", "--repeat", type="int", default=5,
+                      help="Mediciones por caso (se informa la mejor)")
+    options, args = parser.parse_args()
+
+    datadir = tempfile.mkdtemp(prefix='hftp-dispatch-')
+    local, remote = socket.socketpair()
+    try:
+        with open(os.path.join(datadir, 'file'), 'wb') as f:
+            f.write(b'hello world\n')
+        conn = connection.Connection(local, datadir)
+        print("%-26s %12s %12s" % ("caso", "anterior", "registro"))
+        for description, line in CASES:
+            legacy = best(lambda l: legacy_dispatch(conn, l), conn, line,
+                          options.count, options.repeat)
+            current = best(conn.which_command, conn, line, options.count,
+                           options.repeat)
+            print("%-26s %9.0f ns %9.0f ns" % (description, legacy * 1e9,
+                                               current * 1e9))
+    finally:
+        local.close()
+        remote.close()
+        shutil.rmtree(datadir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Microbenchmark del framing de líneas: compara framing.LineBuffer con el
+esquema anterior (buscar EOL en todo el str acumulado y partirlo con split)
+alimentando los datos de a 4096 bytes, como llegan de recv.
+
+Casos: muchos comandos pipelineados en un solo envío y un fragmento base64
+grande en una única línea. El esquema anterior es cuadrático, por lo que
+con fragmentos más grandes que --legacy-max se omite.
+
+Uso: python bench-framing.py [-c 10000] [-f 100M] [--legacy-max 8M]
+"""
+
+import optparse
+import time
+
+from constants import EOL
+from framing import LineBuffer
+
+RECV_SIZE = 4096
+UNITS = {'K': 2**10, 'M': 2**20, 'G': 2**30}
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    if text and text[-1] in UNITS:
+        return int(text[:-1]) * UNITS[text[-1]]
+    return int(text)
+
+
+def legacy_lines(payload):
+    """
+    Framing anterior, sobre str.
+    """
+    buffer = ""
+    count = 0
+    for i in range(0, len(payload), RECV_SIZE):
+        buffer += payload[i:i + RECV_SIZE].decode("ascii")
+        while EOL in buffer:
+            line, buffer = buffer.split(EOL, 1)
+            count += 1
+    return count
+
+
+def linebuffer_lines(payload):
+    buffer = LineBuffer()
+    count = 0
+    for i in range(0, len(payload), RECV_SIZE):
+        buffer.feed(payload[i:i + RECV_SIZE])
+        while buffer.next_line() is not None:
+            count += 1
+    return count
+
+
+def measure(func, payload):
+    start = time.perf_counter()
+    count = func(payload)
+    return time.perf_counter() - start, count
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("-c", "--commands", type="int", default=10000,
+                      help="Cantidad de comandos pipelineados")
+    parser.add_option("-f", "--fragment", default="100M",
+                      help="Tamaño de la línea del fragmento grande")
+    parser.add_option("--legacy-max", default="8M",
+                      help="Fragmento máximo para medir el esquema anterior")
+    options, args = parser.parse_args()
+    fragment = parse_size(options.fragment)
+
+    commands = ("get_metadata archivo%d.txt" + EOL)
+    cases = [
+        ("%d comandos" % options.commands,
+         b"".join((commands % i).encode("ascii")
+                  for i in range(options.commands)), True),
+        ("fragmento de %d bytes" % fragment,
+         b"A" * fragment + EOL.encode("ascii"),
+         fragment <= parse_size(options.legacy_max)),
+    ]
+    print("%-28s %14s %14s" % ("caso", "anterior (s)", "LineBuffer (s)"))
+    for name, payload, run_legacy in cases:
+        new, count = measure(linebuffer_lines, payload)
+        if run_legacy:
+            old, old_count = measure(legacy_lines, payload)
+            assert old_count == count
+            old = "%14.4f" % old
+        else:
+            old = "%14s" % "omitido"
+        print("%-28s %s %14.4f" % (name, old, new))
+
+
+if __name__ == '__main__':
+    main()
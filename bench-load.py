@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Benchmark de carga: levanta un server.Server en localhost (en un proceso
+aparte) sobre un directorio temporal con archivos de los tamaños pedidos y
+lo ataca durante un tiempo fijo con muchos clientes concurrentes, cada uno
+con su conexión, que eligen al azar entre get_file_listing, get_metadata y
+get_slice (de un archivo completo) según los pesos de --mix.
+
+Los clientes corren como hilos repartidos en varios procesos, para que el
+GIL de un solo proceso no sea el cuello de botella. Al final imprime un
+JSON con pedidos por segundo, MB/s, latencias p50/p99 (total y por
+comando), errores y la memoria residente del servidor, para comparar
+motores y detectar regresiones.
+
+Uso: python bench-load.py [-e threads|async] [-c 32] [-t 10]
+         [--mix listing=1,metadata=5,slice=4] [-s 4K,1M,16M] [-m base64]
+"""
+
+import json
+import multiprocessing
+import optparse
+import os
+import random
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import client
+import server
+from constants import *
+
+UNITS = {'K': 2**10, 'M': 2**20, 'G': 2**30}
+OPERATIONS = ('listing', 'metadata', 'slice')
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    if text and text[-1] in UNITS:
+        return int(text[:-1]) * UNITS[text[-1]]
+    return int(text)
+
+
+def parse_mix(text):
+    """
+    Convierte "listing=1,metadata=5" en un diccionario de pesos.
+    """
+    mix = {}
+    for item in text.split(','):
+        name, weight = item.split('=')
+        if name not in OPERATIONS:
+            raise ValueError("Operación desconocida: %s" % name)
+        mix[name] = float(weight)
+    return mix
+
+
+def make_file(path, size):
+    """
+    Crea un archivo de `size' bytes repitiendo un bloque aleatorio.
+    """
+    block = os.urandom(min(size, 2**20))
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            f.write(block[:remaining])
+            remaining -= len(block)
+
+
+def run_server(port, datadir, options):
+    # Los mensajes del servidor no se mezclan con el JSON del resultado.
+    sys.stdout = open(os.devnull, 'w')
+    srv = server.Server('127.0.0.1', port, datadir, options.engine,
+                        processes=options.server_processes)
+    srv.serve()
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def rss_kb(pid):
+    """
+    Devuelve (VmRSS, VmHWM) en KiB del proceso y sus hijos, leídos de
+    /proc (sólo Linux), o (None, None).
+    """
+    pids = [pid]
+    try:
+        for entry in os.listdir('/proc'):
+            if entry.isdigit():
+                with open('/proc/%s/stat' % entry) as f:
+                    # El nombre del proceso va entre paréntesis y puede
+                    # tener espacios: el ppid es el segundo campo después.
+                    if int(f.read().rsplit(')', 1)[1].split()[1]) == pid:
+                        pids.append(int(entry))
+    except OSError:
+        return None, None
+    current = peak = 0
+    for p in pids:
+        try:
+            with open('/proc/%d/status' % p) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        current += int(line.split()[1])
+                    elif line.startswith('VmHWM:'):
+                        peak += int(line.split()[1])
+        except OSError:
+            pass
+    return current, peak
+
+
+def client_thread(port, files, mix, mode, deadline, results):
+    """
+    Un cliente: hace pedidos hasta `deadline' y agrega a results tuplas
+    (operación, segundos, bytes recibidos, ok).
+    """
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    rng = random.Random()
+    c = client.Client('127.0.0.1', port)
+    if mode != 'base64':
+        c.set_mode(mode)
+    while time.monotonic() < deadline and c.connected:
+        op = rng.choices(names, weights)[0]
+        filename, size = rng.choice(files)
+        start = time.perf_counter()
+        received = 0
+        if op == 'listing':
+            ok = len(c.file_lookup()) == len(files)
+        elif op == 'metadata':
+            ok = c.get_metadata(filename) == size
+        else:
+            data = c.read_slice(filename, 0, size)
+            ok = data is not None and len(data) == size
+            received = size if ok else 0
+        results.append((op, time.perf_counter() - start, received, ok))
+    if c.connected:
+        c.close()
+
+
+def client_process(port, files, mix, mode, threads, duration, queue):
+    deadline = time.monotonic() + duration
+    results = []
+    workers = [threading.Thread(target=client_thread,
+                                args=(port, files, mix, mode, deadline,
+                                      results))
+               for _ in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    queue.put(results)
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def summarize(results, elapsed):
+    latencies = [r[1] for r in results]
+    summary = {
+        'requests': len(results),
+        'errors': sum(1 for r in results if not r[3]),
+        'rps': round(len(results) / elapsed, 1),
+        'mb_per_s': round(sum(r[2] for r in results) / elapsed / 2**20, 2),
+        'latency_ms': {
+            'p50': _ms(percentile(latencies, 0.5)),
+            'p99': _ms(percentile(latencies, 0.99)),
+        },
+        'operations': {},
+    }
+    for op in OPERATIONS:
+        times = [r[1] for r in results if r[0] == op]
+        if times:
+            summary['operations'][op] = {
+                'requests': len(times),
+                'p50_ms': _ms(percentile(times, 0.5)),
+                'p99_ms': _ms(percentile(times, 0.99)),
+            }
+    return summary
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("-e", "--engine", type="choice",
+                      choices=list(ENGINES), default=DEFAULT_ENGINE)
+    parser.add_option("--server-processes", type="int", default=1,
+                      help="Procesos del servidor")
+    parser.add_option("-c", "--clients", type="int", default=32,
+                      help="Clientes concurrentes (una conexión cada uno)")
+    parser.add_option("--client-processes", type="int",
+                      default=os.cpu_count() or 1,
+                      help="Procesos entre los que se reparten los clientes")
+    parser.add_option("-t", "--duration", type="float", default=10,
+                      help="Segundos de carga")
+    parser.add_option("--mix", default="listing=1,metadata=5,slice=4",
+                      help="Pesos de cada operación")
+    parser.add_option("-s", "--sizes", default="4K,1M,16M",
+                      help="Tamaños de los archivos separados por comas")
+    parser.add_option("-m", "--mode", type="choice",
+                      choices=list(TRANSFER_MODES), default='base64',
+                      help="Modo de transferencia de get_slice")
+    parser.add_option("-p", "--port", type="int", default=DEFAULT_PORT + 20)
+    options, args = parser.parse_args()
+    mix = parse_mix(options.mix)
+    sizes = [parse_size(x) for x in options.sizes.split(',')]
+
+    datadir = tempfile.mkdtemp(prefix='hftp-load-')
+    files = []
+    for size in sizes:
+        filename = 'load%d' % size
+        make_file(os.path.join(datadir, filename), size)
+        files.append((filename, size))
+
+    srv = multiprocessing.Process(target=run_server,
+                                  args=(options.port, datadir, options))
+    srv.start()
+    try:
+        wait_for_port(options.port)
+        procs = max(1, min(options.client_processes, options.clients))
+        queue = multiprocessing.Queue()
+        clients = []
+        for i in range(procs):
+            threads = options.clients // procs + \
+                (1 if i < options.clients % procs else 0)
+            p = multiprocessing.Process(
+                target=client_process,
+                args=(options.port, files, mix, options.mode, threads,
+                      options.duration, queue))
+            p.start()
+            clients.append(p)
+        start = time.monotonic()
+        # La memoria se mide con la carga en curso.
+        time.sleep(options.duration / 2)
+        rss_during, _ = rss_kb(srv.pid)
+        results = []
+        for _ in clients:
+            results.extend(queue.get())
+        elapsed = time.monotonic() - start
+        for p in clients:
+            p.join()
+        rss_after, rss_peak = rss_kb(srv.pid)
+    finally:
+        os.kill(srv.pid, signal.SIGTERM)
+        srv.join(SHUTDOWN_TIMEOUT + 5)
+        shutil.rmtree(datadir, ignore_errors=True)
+
+    report = {
+        'engine': options.engine,
+        'server_processes': options.server_processes,
+        'clients': options.clients,
+        'duration_s': round(elapsed, 3),
+        'mode': options.mode,
+        'mix': mix,
+        'file_sizes': sizes,
+    }
+    report.update(summarize(results, elapsed))
+    report['server_rss_kb'] = {'during': rss_during, 'after': rss_after,
+                               'peak': rss_peak}
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
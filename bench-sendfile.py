@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Benchmark de get_slice completo: compara el camino base64 (lectura y
+codificación en Python) con el modo binario (os.sendfile en el kernel).
+
+Levanta un server.Server en localhost sobre un directorio temporal, crea
+archivos de los tamaños pedidos y mide cuánto tarda en llegar cada archivo
+completo. El cliente sólo cuenta bytes (no decodifica ni escribe a disco)
+para medir el costo del lado del servidor.
+
+Uso: python bench-sendfile.py [-s 1M,100M,1G] [-r 3] [-e threads|async]
+"""
+
+import optparse
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+import server
+from constants import *
+
+UNITS = {'K': 2**10, 'M': 2**20, 'G': 2**30}
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    if text and text[-1] in UNITS:
+        return int(text[:-1]) * UNITS[text[-1]]
+    return int(text)
+
+
+def make_file(path, size):
+    """
+    Crea un archivo de `size' bytes repitiendo un bloque aleatorio.
+    """
+    block = os.urandom(2**20)
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            f.write(block[:remaining])
+            remaining -= len(block)
+
+
+def recv_line(s, buf):
+    """
+    Lee de s hasta tener una línea completa en buf y la devuelve.
+    """
+    eol = EOL.encode("ascii")
+    while eol not in buf:
+        data = s.recv(2**16)
+        if not data:
+            raise ConnectionError("El server cerró la conexión")
+        buf += data
+    i = buf.index(eol)
+    line = bytes(buf[:i])
+    del buf[:i + len(eol)]
+    return line.decode("ascii")
+
+
+def fetch(s, buf, filename, size, mode):
+    """
+    Pide el archivo completo y consume la respuesta. Devuelve los bytes
+    recibidos del cuerpo.
+    """
+    s.sendall(('get_slice %s 0 %d\r\n' % (filename, size)).encode("ascii"))
+    status = recv_line(s, buf)
+    assert status.startswith('%d ' % CODE_OK), status
+    if mode == 'binary':
+        expected = int(recv_line(s, buf))
+        received = len(buf)
+        buf.clear()
+        while received < expected:
+            data = s.recv(2**20)
+            if not data:
+                break
+            received += len(data)
+        return received
+    # base64: cuerpo terminado en EOL; sólo miramos el final de cada recv
+    eol = EOL.encode("ascii")
+    tail = bytes(buf)
+    received = len(buf)
+    buf.clear()
+    while not tail.endswith(eol):
+        data = s.recv(2**20)
+        if not data:
+            break
+        received += len(data)
+        tail = (tail + data)[-2:]
+    return received - len(eol)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("-s", "--sizes", default="1M,100M,1G",
+                      help="Tamaños de archivo separados por comas")
+    parser.add_option("-r", "--repeat", type="int", default=3,
+                      help="Repeticiones por tamaño y modo")
+    parser.add_option("-e", "--engine", type="choice",
+                      choices=list(ENGINES), default=DEFAULT_ENGINE)
+    parser.add_option("-p", "--port", type="int", default=DEFAULT_PORT + 10)
+    options, args = parser.parse_args()
+    sizes = [parse_size(x) for x in options.sizes.split(',')]
+
+    datadir = tempfile.mkdtemp(prefix='hftp-bench-')
+    srv = server.Server('127.0.0.1', options.port, datadir, options.engine)
+    t = threading.Thread(target=srv.serve, daemon=True)
+    t.start()
+    try:
+        print("%10s %8s %10s %10s" % ("tamaño", "modo", "segundos", "MB/s"))
+        for size in sizes:
+            filename = 'bench%d' % size
+            make_file(os.path.join(datadir, filename), size)
+            for mode in ('base64', 'binary'):
+                s = socket.create_connection(('127.0.0.1', options.port))
+                buf = bytearray()
+                s.sendall(('set_mode %s\r\n' % mode).encode("ascii"))
+                recv_line(s, buf)
+                best = None
+                for _ in range(options.repeat):
+                    start = time.perf_counter()
+                    fetch(s, buf, filename, size, mode)
+                    elapsed = time.perf_counter() - start
+                    best = elapsed if best is None else min(best, elapsed)
+                s.sendall(b'quit\r\n')
+                s.close()
+                print("%10d %8s %10.4f %10.1f" % (size, mode, best,
+                                                  size / best / 2**20))
+            os.remove(os.path.join(datadir, filename))
+    finally:
+        srv.stop()
+        shutil.rmtree(datadir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+# encoding: utf-8
+# Cache LRU de bloques de archivos, compartido por las conexiones.
+
+import os
+import threading
+from binascii import b2a_base64
+from collections import OrderedDict
+from constants import *
+
+
+class ByteLRU(object):
+    """
+    Diccionario LRU de valores bytes con un presupuesto total en bytes.
+    Cuando se excede se descartan las entradas usadas hace más tiempo.
+    Es seguro para usar desde varios hilos.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.entries = OrderedDict()
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Devuelve el valor de key, o None si no está.
+        """
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """
+        Guarda value en key, salvo que solo ya exceda el presupuesto.
+        """
+        if len(value) > self.budget:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.used -= len(old)
+            self.entries[key] = value
+            self.used += len(value)
+            while self.used > self.budget:
+                _, evicted = self.entries.popitem(last=False)
+                self.used -= len(evicted)
+
+    def discard(self, predicate):
+        """
+        Descarta las entradas cuya clave cumple predicate.
+        """
+        with self.lock:
+            for key in [k for k in self.entries if predicate(k)]:
+                self.used -= len(self.entries.pop(key))
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "bytes": self.used, "entries": len(self.entries)}
+
+
+class BlockCache(object):
+    """
+    Cache de bloques de block_size bytes de los archivos servidos, junto
+    con su codificación en base64. Las claves incluyen (mtime, tamaño) del
+    archivo, así que un archivo modificado nunca devuelve bloques viejos; al
+    notar el cambio además se descartan sus bloques anteriores.
+
+    block_size debe ser múltiplo de 3, para que la codificación de un
+    bloque sea un pedazo de la codificación de cualquier slice que empiece
+    en una posición múltiplo de 3 dentro de él.
+    """
+
+    def __init__(self, budget, block_size=CACHE_BLOCK_SIZE,
+                 max_stamps=CACHE_MAX_STAMPS):
+        assert block_size % 3 == 0
+        self.block_size = block_size
+        self.lru = ByteLRU(budget)
+        # ruta -> último (mtime, tamaño) visto, de los max_stamps archivos
+        # usados más recientemente.
+        self.stamps = OrderedDict()
+        self.max_stamps = max_stamps
+        self.lock = threading.Lock()
+
+    def stamp(self, path, st):
+        """
+        Devuelve la marca de versión del archivo según su os.stat_result,
+        descartando los bloques de versiones anteriores si cambió. Si la
+        marca de un archivo ya se olvidó, sus bloques viejos no se
+        descartan enseguida, pero tampoco se devuelven (la marca es parte
+        de la clave): salen del cache como cualquier bloque sin uso.
+        """
+        stamp = (st.st_mtime_ns, st.st_size)
+        with self.lock:
+            old = self.stamps.get(path)
+            self.stamps[path] = stamp
+            self.stamps.move_to_end(path)
+            if len(self.stamps) > self.max_stamps:
+                self.stamps.popitem(last=False)
+        if old is not None and old != stamp:
+            self.lru.discard(lambda key: key[1] == path and key[2] == old)
+        return stamp
+
+    def raw_block(self, fd, path, stamp, index):
+        """
+        Devuelve el bloque número index del archivo abierto en fd.
+        """
+        key = ("raw", path, stamp, index)
+        block = self.lru.get(key)
+        if block is None:
+            block = os.pread(fd, self.block_size, index * self.block_size)
+            self.lru.put(key, block)
+        return block
+
+    def encoded_block(self, fd, path, stamp, index):
+        """
+        Devuelve el bloque número index codificado en base64.
+        """
+        key = ("b64", path, stamp, index)
+        encoded = self.lru.get(key)
+        if encoded is None:
+            encoded = b2a_base64(self.raw_block(fd, path, stamp, index),
+                                 newline=False)
+            self.lru.put(key, encoded)
+        return encoded
+
+    def compressed_slice(self, path, stamp, offset, size, level):
+        """
+        Devuelve el slice comprimido con zlib guardado con put_compressed,
+        o None si no está.
+        """
+        return self.lru.get(("zlib", path, stamp, offset, size, level))
+
+    def put_compressed(self, path, stamp, offset, size, level, data):
+        """
+        Guarda la versión comprimida de un slice. Se descarta junto con los
+        bloques del archivo cuando éste cambia.
+        """
+        if len(data) <= COMPRESS_CACHE_MAX:
+            self.lru.put(("zlib", path, stamp, offset, size, level), data)
+
+    def stats(self):
+        """
+        Devuelve los contadores de aciertos y fallos y la ocupación.
+        """
+        return self.lru.stats()
@@ -0,0 +1,134 @@
+# encoding: utf-8
+# Sumas de verificación de archivos, con cache y un pool de hilos para las
+# de archivos grandes.
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from constants import *
+
+
+def file_digest(path, offset=0, length=None, algorithm=CHECKSUM_ALGORITHM):
+    """
+    Calcula la suma (en hexadecimal) de `length' bytes del archivo desde
+    offset, o hasta el final si length es None. Lee de a CHECKSUM_CHUNK_SIZE
+    bytes sobre un único buffer; hashlib suelta el GIL mientras procesa
+    cada parte, así varias sumas avanzan en paralelo.
+    """
+    digest = hashlib.new(algorithm)
+    view = memoryview(bytearray(CHECKSUM_CHUNK_SIZE))
+    with open(path, "rb", buffering=0) as f:
+        if length is None:
+            length = os.fstat(f.fileno()).st_size - offset
+        f.seek(offset)
+        while length > 0:
+            n = f.readinto(view[:min(len(view), length)])
+            if not n:
+                break  # El archivo se achicó
+            digest.update(view[:n])
+            length -= n
+    return digest.hexdigest()
+
+
+class Checksums(object):
+    """
+    Sumas de los archivos servidos (o de rangos suyos), guardadas por
+    (ruta, tamaño, mtime, rango): un archivo modificado nunca devuelve la
+    suma vieja. Se conservan las últimas max_entries.
+
+    digest devuelve un concurrent.futures.Future. Las sumas de hasta
+    inline_max bytes se calculan en el momento; las más grandes, en un
+    pool de `workers' hilos, para no demorar al hilo o al event loop que
+    atiende la conexión. Si varias conexiones piden a la vez la misma suma
+    comparten el cálculo. Es seguro para usar desde varios hilos.
+    """
+
+    def __init__(self, workers=DEFAULT_CHECKSUM_WORKERS,
+                 inline_max=CHECKSUM_INLINE_MAX,
+                 max_entries=CHECKSUM_CACHE_ENTRIES,
+                 algorithm=CHECKSUM_ALGORITHM):
+        self.algorithm = algorithm
+        self.inline_max = inline_max
+        self.max_entries = max_entries
+        self.pool = ThreadPoolExecutor(workers,
+                                       thread_name_prefix="checksum")
+        self.digests = OrderedDict()  # clave -> suma en hexadecimal
+        self.running = {}  # clave -> Future de las sumas en curso
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def digest(self, path, offset=0, length=None):
+        """
+        Devuelve un Future con la suma de `length' bytes del archivo desde
+        offset (o hasta el final si length es None). Si el archivo no
+        existe genera una excepción OSError.
+        """
+        st = os.stat(path)
+        if length is None:
+            length = st.st_size - offset
+        key = (path, st.st_size, st.st_mtime_ns, offset, length)
+        with self.lock:
+            value = self.digests.get(key)
+            if value is not None:
+                self.digests.move_to_end(key)
+                self.hits += 1
+                future = Future()
+                future.set_result(value)
+                return future
+            self.misses += 1
+            future = self.running.get(key)
+            if future is not None:
+                return future
+            if length > self.inline_max:
+                future = self.pool.submit(file_digest, path, offset, length,
+                                          self.algorithm)
+                self.running[key] = future
+        if future is None:
+            future = Future()
+            try:
+                future.set_result(file_digest(path, offset, length,
+                                              self.algorithm))
+            except Exception as e:
+                future.set_exception(e)
+        future.add_done_callback(lambda f: self._store(key, f))
+        return future
+
+    def _store(self, key, future):
+        with self.lock:
+            self.running.pop(key, None)
+            if future.cancelled() or future.exception() is not None:
+                return
+            self.digests[key] = future.result()
+            self.digests.move_to_end(key)
+            while len(self.digests) > self.max_entries:
+                self.digests.popitem(last=False)
+
+    def close(self):
+        self.pool.shutdown(wait=False)
+
+    def stats(self):
+        """
+        Devuelve los contadores de aciertos y fallos y las sumas guardadas.
+        """
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "entries": len(self.digests)}
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared_checksums():
+    """
+    Devuelve las Checksums compartidas por las conexiones de este proceso
+    que no recibieron unas propias.
+    """
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = Checksums()
+        return _shared
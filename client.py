@@ -9,10 +9,72 @@
 import socket
 import logging
 import optparse
+import os
 import sys
+import threading
 import time
-from base64 import b64decode
+from concurrent.futures import ThreadPoolExecutor
+from checksum import file_digest
 from constants import *
+from framing import FragmentDecoder, LineBuffer
+
+
+class DownloadJournal(object):
+    """
+    Registro en disco de los pedazos ya bajados de un archivo, para poder
+    retomar una descarga interrumpida. Es un archivo de texto junto a la
+    salida: una cabecera con el tamaño del archivo y de los pedazos y la
+    suma de verificación del archivo en el server, y luego una línea
+    "offset longitud" por cada pedazo terminado.
+
+    Un registro anterior sólo se usa si su cabecera coincide (el archivo
+    del server no cambió, aunque conserve el tamaño) y la salida `output'
+    existe y tiene el tamaño final; si no, la descarga empieza de cero. Sin
+    suma (digest None, p. ej. un server sin get_checksum) nunca se retoma.
+    """
+
+    HEADER = "HFTP-JOURNAL %d %d %s\n"
+
+    def __init__(self, path, size, chunk_size, digest, output):
+        self.path = path
+        self.lock = threading.Lock()
+        self.done = set()
+        header = self.HEADER % (size, chunk_size, digest or "-")
+        try:
+            if digest is not None and os.path.getsize(output) == size:
+                with open(path) as f:
+                    if f.readline() == header:
+                        for line in f:
+                            parts = line.split()
+                            # Una última línea cortada por la interrupción
+                            # se ignora: ese pedazo se vuelve a pedir.
+                            if len(parts) == 2 and line.endswith("\n"):
+                                self.done.add(int(parts[0]))
+        except (OSError, ValueError):
+            self.done = set()
+        self.resumed = bool(self.done)
+        self.file = open(path, "a" if self.resumed else "w")
+        if not self.resumed:
+            self.file.write(header)
+            self.file.flush()
+
+    def record(self, offset, length):
+        """
+        Anota un pedazo terminado. Los datos ya escritos con pwrite quedan
+        en el cache del sistema, así que sobreviven a que muera el proceso.
+        """
+        with self.lock:
+            self.file.write("%d %d\n" % (offset, length))
+            self.file.flush()
+            self.done.add(offset)
+
+    def close(self, completed):
+        """
+        Cierra el registro, borrándolo si la descarga se completó.
+        """
+        self.file.close()
+        if completed:
+            os.remove(self.path)
 
 
 class Client(object):
@@ -26,9 +88,12 @@ class Client(object):
         """
         self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.status = None
+        self.server = server
+        self.port = port
         self.s.connect((server, port))
-        self.buffer = ''
+        self.buffer = LineBuffer()
         self.connected = True
+        self.mode = 'base64'  # modo de transferencia de get_slice
 
     def close(self):
         """
@@ -68,8 +133,8 @@ class Client(object):
         Para uso privado del cliente.
         """
         self.s.settimeout(timeout)
-        data = self.s.recv(4096).decode("ascii")
-        self.buffer += data
+        data = self.s.recv(RECV_SIZE)
+        self.buffer.feed(data)
 
         if len(data) == 0:
             logging.info("El server interrumpió la conexión.")
@@ -83,7 +148,8 @@ class Client(object):
         Devuelve la línea, eliminando el terminaodr y los espacios en blanco
         al principio y al final.
         """
-        while not EOL in self.buffer and self.connected:
+        response = self.buffer.next_line()
+        while response is None and self.connected:
             if timeout is not None:
                 t1 = time.process_time()
             self._recv(timeout)
@@ -91,13 +157,22 @@ class Client(object):
                 t2 = time.process_time()
                 timeout -= t2 - t1
                 t1 = t2
-        if EOL in self.buffer:
-            response, self.buffer = self.buffer.split(EOL, 1)
-            return response.strip()
+            response = self.buffer.next_line()
+        if response is not None:
+            return response.decode("ascii").strip()
         else:
             self.connected = False
             return ""
 
+    def read_exact(self, length, timeout=None):
+        """
+        Espera hasta tener `length' bytes crudos y los devuelve. Si el
+        server corta antes, devuelve lo que haya llegado.
+        """
+        while len(self.buffer) < length and self.connected:
+            self._recv(timeout)
+        return self.buffer.take(length)
+
     def read_response_line(self, timeout=None):
         """
         Espera y parsea una línea de respuesta de un comando.
@@ -123,14 +198,42 @@ class Client(object):
 
         Devuelve el contenido del fragmento.
         """
-        # Ahora, esperamos hasta tener la cantidad de datos necesaria
-        data = self.read_line()
-        fragment = b64decode(data)
-        while len(fragment) < length:
-            data = self.read_line()
-            fragment += b64decode(data)
+        fragment = bytearray()
+        self.read_fragment_into(length, fragment.extend)
+        return bytes(fragment)
 
-        return fragment
+    def read_fragment_into(self, length, write):
+        """
+        Lee un fragmento de `length' bytes a medida que llega, pasando los
+        datos decodificados de a partes a write(bytes), sin juntarlo entero
+        en memoria. En modo base64 se decodifica sólo la parte que completa
+        grupos de 4 caracteres y el resto se guarda para la próxima.
+
+        Devuelve la cantidad de bytes decodificados.
+        """
+        decoder = FragmentDecoder(self.mode, length)
+        while True:
+            for piece in decoder.consume(self.buffer):
+                write(piece)
+            if decoder.done or not self.connected:
+                return decoder.received
+            self._recv()
+
+    def set_mode(self, mode):
+        """
+        Elige el modo de transferencia de get_slice para esta conexión:
+        'base64' (el del protocolo), 'binary' (bytes crudos, sin el
+        sobrecosto de base64) o 'zlib' (comprimido, para archivos de texto).
+        Devuelve True si el server lo aceptó.
+        """
+        self.send('set_mode %s' % mode)
+        self.status, message = self.read_response_line()
+        if self.status == CODE_OK:
+            self.mode = mode
+            return True
+        logging.warning("El servidor no aceptó el modo %s (code=%s %s)."
+                        % (mode, self.status, message))
+        return False
 
     def file_lookup(self):
         """
@@ -163,6 +266,63 @@ class Client(object):
             size = int(self.read_line())
             return size
 
+    def read_sizes(self):
+        """
+        Lee las líneas "nombre tamaño" de una respuesta, hasta la línea
+        vacía. Devuelve un diccionario nombre -> tamaño.
+        """
+        result = {}
+        line = self.read_line()
+        while line:
+            name, size = line.rsplit(' ', 1)
+            result[name] = int(size)
+            line = self.read_line()
+        return result
+
+    def get_metadata_many(self, filenames):
+        """
+        Obtiene en un solo pedido el tamaño de varios archivos. Devuelve un
+        diccionario nombre -> tamaño sin los archivos que no existen, o
+        None en caso de error.
+        """
+        self.send('get_metadata_many %s' % ' '.join(filenames))
+        self.status, message = self.read_response_line()
+        if self.status == CODE_OK:
+            return self.read_sizes()
+        logging.warning("Falló la solicitud de tamaños (code=%s %s)."
+                        % (self.status, message))
+
+    def file_lookup_with_sizes(self):
+        """
+        Obtiene el listado de los archivos del server junto con sus
+        tamaños. Devuelve un diccionario nombre -> tamaño.
+        """
+        self.send('get_file_listing_with_sizes')
+        self.status, message = self.read_response_line()
+        if self.status == CODE_OK:
+            return self.read_sizes()
+        logging.warning("Falló la solicitud de la lista de archivos" +
+                        "(code=%s %s)." % (self.status, message))
+        return {}
+
+    def get_stats(self):
+        """
+        Obtiene las métricas del server, en el formato de texto de
+        Prometheus. Devuelve una lista de líneas, o None en caso de error.
+        """
+        self.send('stats')
+        self.status, message = self.read_response_line()
+        if self.status != CODE_OK:
+            logging.warning("Falló la solicitud de métricas (code=%s %s)."
+                            % (self.status, message))
+            return None
+        result = []
+        line = self.read_line()
+        while line:
+            result.append(line)
+            line = self.read_line()
+        return result
+
     def get_slice(self, filename, start, length):
         """
         Obtiene un trozo de un archivo en el server.
@@ -170,31 +330,240 @@ class Client(object):
         El archivo es guardado localmente, en el directorio actual, con el
         mismo nombre que tiene en el server.
         """
+        output = None
+
+        def write(data):
+            nonlocal output
+            if output is None:
+                output = open(filename, 'wb')
+            output.write(data)
+
+        if self.fetch_slice(filename, start, length, write) is not None:
+            if output is None:
+                output = open(filename, 'wb')  # slice vacío
+            output.close()
+        elif output is not None:
+            output.close()
+
+    def read_slice(self, filename, start, length):
+        """
+        Obtiene un trozo de un archivo en el server y lo devuelve, sin
+        guardarlo. Devuelve None en caso de error.
+        """
+        fragment = bytearray()
+        if self.fetch_slice(filename, start, length,
+                            fragment.extend) is None:
+            return None
+        return bytes(fragment)
+
+    def get_checksum(self, filename, start=None, length=None):
+        """
+        Obtiene la suma de verificación que calcula el server del archivo,
+        o de `length' bytes desde start. Devuelve un par (algoritmo, suma
+        en hexadecimal), o None en caso de error.
+        """
+        if start is None:
+            self.send('get_checksum %s' % filename)
+        else:
+            self.send('get_checksum %s %d %d' % (filename, start, length))
+        self.status, message = self.read_response_line()
+        if self.status != CODE_OK:
+            logging.warning("Falló la solicitud de la suma de %s "
+                            "(code=%s %s)." % (filename, self.status,
+                                               message))
+            return None
+        algorithm, digest = self.read_line().split(' ', 1)
+        return algorithm, digest
+
+    def unchanged(self, filename, size):
+        """
+        Indica si el archivo local `filename' es igual al del server, de
+        tamaño `size': compara los tamaños y, si coinciden, las sumas de
+        verificación.
+        """
+        try:
+            if os.path.getsize(filename) != size:
+                return False
+        except OSError:
+            return False
+        remote = self.get_checksum(filename)
+        if remote is None:
+            return False
+        algorithm, digest = remote
+        try:
+            return file_digest(filename, algorithm=algorithm) == digest
+        except (OSError, ValueError):  # ValueError: algoritmo desconocido
+            return False
+
+    def get_slices(self, filename, ranges):
+        """
+        Obtiene en un solo pedido varios trozos de un archivo en el server,
+        sin guardarlos. ranges es una lista de pares (inicio, largo).
+        Devuelve una lista con los fragmentos, en el mismo orden, o None en
+        caso de error.
+        """
+        self.send('get_slices %s %s' % (filename, ' '.join(
+            '%d %d' % (start, length) for start, length in ranges)))
+        self.status, message = self.read_response_line()
+        if self.status != CODE_OK:
+            logging.warning("El servidor indico un error al leer de %s "
+                            "(code=%s %s)." % (filename, self.status,
+                                               message))
+            return None
+        result = []
+        for _, length in ranges:
+            fragment = bytearray()
+            self.read_fragment_into(length, fragment.extend)
+            result.append(bytes(fragment))
+        return result
+
+    def fetch_slice(self, filename, start, length, write):
+        """
+        Pide un trozo de un archivo y pasa sus datos a write(bytes) a medida
+        que llegan (ver read_fragment_into). Devuelve la cantidad de bytes
+        recibidos, o None si el server indicó un error.
+        """
         self.send('get_slice %s %d %d' % (filename, start, length))
         self.status, message = self.read_response_line()
         if self.status == CODE_OK:
-            output = open(filename, 'wb')
-            fragment = self.read_fragment(length)
-            output.write(fragment)
-            output.close()
-        else:
-            logging.warning("El servidor indico un error al leer de %s."
-                            % filename)
+            return self.read_fragment_into(length, write)
+        logging.warning("El servidor indico un error al leer de %s."
+                        % filename)
+        return None
 
-    def retrieve(self, filename):
+    def retrieve(self, filename, jobs=1, resume=False, skip_unchanged=False):
         """
         Obtiene un archivo completo desde el servidor.
+
+        Con jobs > 1 los pedazos del archivo se bajan en paralelo por
+        conexiones separadas. Con resume, lo que ya se bajó en un intento
+        anterior interrumpido no se vuelve a pedir (ver retrieve_chunked).
+        Con skip_unchanged, si ya hay un archivo local igual al del server
+        (ver unchanged) no se baja.
         """
         size = self.get_metadata(filename)
         if self.status == CODE_OK:
             assert size >= 0
-            self.get_slice(filename, 0, size)
+            if skip_unchanged and self.unchanged(filename, size):
+                logging.info("%s no cambió, no se baja." % filename)
+                return
+            if (jobs > 1 or resume) and size > 0:
+                self.retrieve_chunked(filename, size, jobs, resume)
+            else:
+                self.get_slice(filename, 0, size)
         elif self.status == FILE_NOT_FOUND:
             logging.info("El archivo solicitado no existe.")
         else:
             logging.warning("No se pudo obtener el archivo %s (code=%s)."
                             % (filename, self.status))
 
+    def retrieve_chunked(self, filename, size, jobs=1, resume=False,
+                         chunk_size=DOWNLOAD_CHUNK_SIZE):
+        """
+        Baja los `size' bytes del archivo de a pedazos de `chunk_size',
+        repartidos entre `jobs' conexiones. El archivo de salida se crea con
+        su tamaño final y cada pedazo se escribe en su posición con
+        os.pwrite.
+
+        Con resume, los pedazos terminados se anotan en un DownloadJournal,
+        junto con la suma del archivo que informa el server: si la descarga
+        se corta, la próxima con resume sólo pide los que faltan, salvo que
+        el archivo haya cambiado. El registro se borra al completar el
+        archivo. Sin resume no se pide la suma, que obliga al server a leer
+        el archivo entero, ni se lleva registro; uno anterior se borra,
+        porque deja de describir la salida.
+        """
+        journal_path = filename + JOURNAL_SUFFIX
+        journal = None
+        if resume:
+            remote = self.get_checksum(filename)
+            digest = "%s:%s" % remote if remote is not None else None
+            journal = DownloadJournal(journal_path, size, chunk_size, digest,
+                                      filename)
+        elif os.path.exists(journal_path):
+            os.remove(journal_path)
+        resumed = journal is not None and journal.resumed
+        flags = os.O_WRONLY | os.O_CREAT
+        if not resumed:
+            flags |= os.O_TRUNC
+        fd = os.open(filename, flags, 0o644)
+        chunks = [(start, min(chunk_size, size - start))
+                  for start in range(0, size, chunk_size)
+                  if not resumed or start not in journal.done]
+        if resumed:
+            logging.info("Retomando %s: faltan %d de %d pedazos."
+                         % (filename, len(chunks), -(-size // chunk_size)))
+        pending = iter(chunks)
+        pending_lock = threading.Lock()
+
+        def worker(client):
+            while True:
+                with pending_lock:
+                    chunk = next(pending, None)
+                if chunk is None:
+                    return CODE_OK
+                start, length = chunk
+                position = [start]
+
+                def write(data):
+                    view = memoryview(data)
+                    while view:
+                        written = os.pwrite(fd, view, position[0])
+                        position[0] += written
+                        view = view[written:]
+
+                received = client.fetch_slice(filename, start, length, write)
+                if client.status != CODE_OK:
+                    return client.status
+                if received != length:
+                    return None
+                if journal is not None:
+                    journal.record(start, length)
+
+        results = []
+        try:
+            os.ftruncate(fd, size)
+            jobs = max(1, min(jobs, len(chunks)))
+            if jobs == 1:
+                results.append(self._run_worker(worker, self))
+            else:
+                with ThreadPoolExecutor(max_workers=jobs) as pool:
+                    results = list(pool.map(
+                        lambda _: self._run_worker(worker), range(jobs)))
+        finally:
+            os.close(fd)
+            failed = [status for status in results if status != CODE_OK]
+            if journal is not None:
+                journal.close(completed=bool(results) and not failed)
+        self.status = failed[0] if failed else CODE_OK
+        if failed:
+            logging.warning("No se pudo completar el archivo %s (code=%s)%s."
+                            % (filename, self.status,
+                               "; se puede retomar luego" if resume else ""))
+
+    def _run_worker(self, worker, client=None):
+        """
+        Corre worker(client) con el cliente dado o, si no se da, con una
+        conexión nueva en el mismo modo de transferencia. Devuelve el código
+        que devuelva worker, o None si se perdió la conexión.
+        """
+        own = client is None
+        try:
+            if own:
+                client = Client(self.server, self.port)
+                if self.mode != 'base64' and not client.set_mode(self.mode):
+                    return client.status
+            return worker(client)
+        except (socket.error, ValueError) as e:
+            logging.warning("Error de conexión durante la descarga: %s" % e)
+            return None
+        finally:
+            if own and client is not None and client.connected:
+                try:
+                    client.close()
+                except socket.error:
+                    pass
+
 
 def main():
     """
@@ -215,6 +584,19 @@ def main():
                       help="Determina cuanta informacion de depuracion a mostrar"
                       "(valores posibles son: ERROR, WARN, INFO, DEBUG)",
                       default="ERROR")
+    parser.add_option("-b", "--binary", action="store_true", default=False,
+                      help="Pedir los archivos en modo binario (sin base64)")
+    parser.add_option("-z", "--compress", action="store_true", default=False,
+                      help="Pedir los archivos comprimidos con zlib")
+    parser.add_option("-j", "--jobs", type="int", default=1,
+                      help="Conexiones en paralelo para bajar el archivo")
+    parser.add_option("-r", "--resume", action="store_true", default=False,
+                      help="Bajar de a pedazos, retomando una descarga "
+                      "interrumpida")
+    parser.add_option("-u", "--skip-unchanged", action="store_true",
+                      default=False,
+                      help="No bajar el archivo si ya hay uno local con la "
+                      "misma suma de verificación")
     options, args = parser.parse_args()
     try:
         port = int(options.port)
@@ -238,6 +620,11 @@ def main():
         sys.stderr.write("Error al conectarse\n")
         sys.exit(1)
 
+    if options.compress:
+        client.set_mode('zlib')
+    elif options.binary:
+        client.set_mode('binary')
+
     print("* Bienvenido al cliente HFTP - "
           "the Home-made File Transfer Protocol *\n"
           "* Estan disponibles los siguientes archivos:")
@@ -249,7 +636,9 @@ def main():
 
     if client.status == CODE_OK:
         print("* Indique el nombre del archivo a descargar:")
-        client.retrieve(input().strip())
+        client.retrieve(input().strip(), jobs=max(options.jobs, 1),
+                        resume=options.resume,
+                        skip_unchanged=options.skip_unchanged)
 
     client.close()
 
@@ -5,11 +5,214 @@
 
 import os
 import socket
+import time
+import zlib
+from collections import deque
 from base64 import b64encode
+from binascii import b2a_base64
+from checksum import shared_checksums
 from constants import *
+from dirindex import shared_index
+from filecache import open_file
+from framing import LineBuffer
+from metrics import REGISTRY as metrics
 from typing import Union
 import logging 
 
+EOL_BYTES = EOL.encode("ascii")
+IOV_MAX = 1024  # máximo de buffers por llamada a sendmsg (Linux)
+# Comandos del protocolo: nombre -> Command. Se agregan con el decorador
+# command sobre el método de Connection que los atiende.
+COMMANDS = {}
+
+
+class Command(object):
+    """
+    Un comando del protocolo: el método de Connection que lo atiende y los
+    tipos de sus argumentos. Cada tipo es una función que convierte el
+    texto del argumento y genera ValueError si no es válido (str, int,
+    transfer_mode...). Un comando variadic recibe, después de los
+    argumentos fijos, una lista de uno o más argumentos del último tipo
+    que declara. Los últimos `optional' argumentos fijos se pueden omitir
+    (el método debe darles un valor por defecto).
+    """
+
+    __slots__ = ("name", "handler", "types", "variadic", "fixed",
+                 "optional", "conversions")
+
+    def __init__(self, name, handler, types, variadic=False, optional=0):
+        assert not variadic or types
+        assert not (variadic and optional)
+        self.name = name
+        self.handler = handler
+        self.types = types
+        self.variadic = variadic
+        self.fixed = len(types) - 1 if variadic else len(types)
+        self.optional = optional
+        # Los argumentos fijos de tipo str quedan como llegaron: sólo se
+        # convierten los demás, en el lugar.
+        self.conversions = [(i, convert)
+                            for i, convert in enumerate(types[:self.fixed])
+                            if convert is not str]
+
+    def parse(self, args):
+        """
+        Convierte los argumentos recibidos (una lista de str, que se
+        modifica) en los que espera el método. Devuelve None si no son
+        válidos.
+        """
+        try:
+            if self.variadic:
+                if len(args) <= self.fixed:
+                    return None
+                rest = args[self.fixed:]
+                convert = self.types[-1]
+                if convert is not str:
+                    rest = [convert(arg) for arg in rest]
+                args = args[:self.fixed]
+                args.append(rest)
+            elif not self.fixed - self.optional <= len(args) <= self.fixed:
+                return None
+            for i, convert in self.conversions:
+                if i < len(args):
+                    args[i] = convert(args[i])
+            return args
+        except ValueError:
+            return None
+
+
+def command(name, *types, variadic=False, optional=0):
+    """
+    Decorador que registra un método de Connection como el que atiende el
+    comando name, con argumentos de los tipos dados (ver Command).
+    """
+    def register(handler):
+        COMMANDS[name] = Command(name, handler, types, variadic, optional)
+        return handler
+    return register
+
+
+def coalesce_ranges(ranges):
+    """
+    Combina los rangos (offset, tamaño) que se superponen o son contiguos.
+    Devuelve la lista de tramos (inicio, fin) a leer, ordenados, y para
+    cada rango, en el orden recibido, un par (número de tramo, posición
+    dentro del tramo) de donde sacar sus datos.
+    """
+    order = sorted(range(len(ranges)), key=lambda i: ranges[i][0])
+    spans = []
+    places = [None] * len(ranges)
+    for i in order:
+        offset, size = ranges[i]
+        if spans and offset <= spans[-1][1]:
+            start, end = spans[-1]
+            spans[-1] = (start, max(end, offset + size))
+        else:
+            spans.append((offset, offset + size))
+        places[i] = (len(spans) - 1, offset - spans[-1][0])
+    return spans, places
+
+
+def _preadv(fd, view, offset):
+    """
+    Lee del archivo, desde offset, directamente sobre el memoryview view.
+    Devuelve la cantidad de bytes leídos.
+    """
+    if hasattr(os, "preadv"):
+        return os.preadv(fd, [view], offset)
+    data = os.pread(fd, len(view), offset)
+    view[:len(data)] = data
+    return len(data)
+
+
+def _frame(data):
+    """
+    Devuelve el pedazo "<largo>\r\n<bytes>" de data para el modo zlib, o
+    nada si data está vacío.
+    """
+    if data:
+        yield b"%d%s" % (len(data), EOL_BYTES)
+        yield data
+
+
+def transfer_mode(text):
+    """
+    Tipo de argumento: uno de TRANSFER_MODES.
+    """
+    if text not in TRANSFER_MODES:
+        raise ValueError(f"Modo de transferencia no válido: {text}")
+    return text
+
+
+class FileRegion(object):
+    """
+    Rango de un archivo encolado para enviar sin pasarlo por Python: se
+    copia del archivo al socket dentro del kernel con os.sendfile.
+    """
+
+    def __init__(self, opened, offset: int, size: int):
+        self.file = opened  # el filecache.OpenFile, que cierra el archivo
+        self.fd = opened.fd
+        self.offset = offset
+        self.remaining = size
+
+
+    def send_to(self, sock: socket.socket, limit=None):
+        """
+        Envía lo que el socket acepte, hasta `limit' bytes si se indica.
+        Devuelve la cantidad de bytes enviados; si el socket no bloquea y
+        está lleno lanza BlockingIOError.
+        """
+        count = self.remaining if limit is None else \
+            min(self.remaining, limit)
+        if hasattr(os, "sendfile"):
+            sent = os.sendfile(sock.fileno(), self.fd, self.offset, count)
+        else:
+            sent = sock.send(os.pread(self.fd, min(count, SLICE_CHUNK_SIZE),
+                                      self.offset))
+        if sent == 0:
+            # El archivo se achicó mientras lo enviábamos.
+            self.remaining = 0
+        self.offset += sent
+        self.remaining -= sent
+        return sent
+
+
+    def close(self):
+        # El descriptor se cierra cuando nadie más usa el OpenFile.
+        self.file = None
+        self.fd = None
+
+
+class PendingReply(object):
+    """
+    Respuesta que se calcula en otro hilo: un concurrent.futures.Future y
+    la función que arma, con su resultado, los bytes a enviar. flush la
+    envía cuando el Future termina, sin adelantar las respuestas que se
+    encolaron después.
+    """
+
+    def __init__(self, future, render):
+        self.future = future
+        self.render = render
+
+
+    def ready(self):
+        return self.future.done()
+
+
+    def data(self):
+        """
+        Espera el resultado y devuelve los bytes de la respuesta; si el
+        cálculo falló, los de INTERNAL_ERROR.
+        """
+        try:
+            return self.render(self.future.result())
+        except Exception:
+            logging.exception("Error al calcular una respuesta")
+            return STATUS_LINES[INTERNAL_ERROR]
+
+
 class Connection(object):
     """
     Conexión punto a punto entre el servidor y un cliente.
@@ -19,23 +222,98 @@ class Connection(object):
 
     # Constructor de la clase Connection. Inicializa el socket, el directorio, 
     # establece la conexión como activa y crea un buffer vacío.
-    def __init__(self, socket: socket.socket, directory):
+    # Las respuestas se encolan en self.outgoing y se envían juntas con
+    # flush. Con blocking=False el socket no bloquea y es el event loop del
+    # servidor quien llama a flush cuando se puede escribir.
+    # index es el DirectoryIndex del que se sacan el listado y los tamaños;
+    # por defecto, el compartido por todas las conexiones del proceso.
+    # cache es un BlockCache compartido para los slices (None: sin cache).
+    # compress_level es el nivel de zlib de los slices en modo "zlib".
+    # limiters son los TokenBucket que limitan el envío de los slices (el de
+    # la conexión y el global); los mensajes cortos no se limitan.
+    # quantum son los bytes de slices que se envían por turno (ver flush);
+    # None envía todo de una vez.
+    # max_line es el largo máximo de una línea; una más larga es BAD_REQUEST.
+    # files es el filecache.OpenFiles con los archivos abiertos desde los
+    # que se leen los slices (ver _open_file); None los abre en cada pedido.
+    # checksums son las checksum.Checksums del proceso (por defecto, las
+    # compartidas).
+    def __init__(self, socket: socket.socket, directory, blocking=True,
+                 index=None, cache=None,
+                 compress_level=DEFAULT_COMPRESS_LEVEL, limiters=(),
+                 quantum=None, max_line=DEFAULT_MAX_LINE, files=None,
+                 checksums=None):
         self.directory = directory
+        self.files = files
+        self.checksums = checksums if checksums is not None \
+            else shared_checksums()
+        # En modo no bloqueante, el servidor pone aquí una función que
+        # recibe la conexión y la vuelve a atender cuando termina de
+        # calcularse una PendingReply que estaba esperando.
+        self.wakeup = None
+        self.max_line = max_line
+        # Instantes (time.monotonic) que usa el Reaper: última actividad,
+        # llegada del comienzo de la línea incompleta del buffer y del
+        # pedido más viejo cuya respuesta no terminó de enviarse.
+        self.last_activity = time.monotonic()
+        self.partial_since = None
+        self.request_started = None
+        self.compress_level = compress_level
+        self.limiters = limiters
+        self.resume_at = 0  # antes de este instante no se envían slices
+        self.quantum = quantum
+        self.deficit = 0  # bytes de slices que quedan en este turno
+        metrics.inc("hftp_connections_total")
+        metrics.inc("hftp_active_connections")
+        self.index = index if index is not None else shared_index(directory)
+        self.cache = cache
         self.socket = socket
         self.connected = True
-        self.buffer = ""
+        self.buffer = LineBuffer()
+        self.blocking = blocking
+        self.outgoing = deque()
+        self.mode = "base64"  # modo de transferencia de get_slice
+        if not blocking:
+            self.socket.setblocking(False)
+        self._disable_nagle()
+
+
+    def _disable_nagle(self):
+        """
+        Desactiva el algoritmo de Nagle: flush ya junta las respuestas en
+        pocas llamadas al sistema, y Nagle retendría la parte final de cada
+        una (p. ej. los datos de un slice chico, que van después de la
+        línea de estado) hasta el ACK demorado del cliente.
+        """
+        try:
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError:
+            pass  # No es un socket TCP
 
 
     def close(self):
         """
         Cierra la conexión y maneja posibles errores de cierre de socket.
         """
-        print("Cerrando conexion...")
+        logging.debug("Cerrando conexion...")
         self.connected = False
+        # Si quedan respuestas encoladas, el socket se cierra recién cuando
+        # flush termine de enviarlas.
+        if not self.outgoing:
+            self._close_socket()
+
+
+    def _close_socket(self):
+        """
+        Cierra el socket subyacente ignorando errores de cierre.
+        """
+        if self.socket.fileno() == -1:
+            return  # Ya estaba cerrado
+        metrics.inc("hftp_active_connections", -1)
         try: 
             self.socket.close()
-        except socket.error:
-            print(f"Error al cerrar la conexion. {socket.error}")
+        except socket.error as e:
+            print(f"Error al cerrar la conexion. {e}")
 
 
     def send(self, message: Union[bytes, str], codif="ascii"):
@@ -57,12 +335,7 @@ class Connection(object):
             else:
                 raise ValueError(f"Codificación no válida: {codif}")
             
-            # Enviamos el mensaje al cliente mientras haya algo para enviar.
-            while len(message) > 0:
-                sent = self.socket.send(message)
-                assert sent > 0
-                message = message[sent:]
-            self.socket.send(EOL.encode("ascii"))  
+            self._write(message + EOL_BYTES)
         except BrokenPipeError:
             logging.error("Error al enviar el mensaje: BrokenPipeError")
             self.connected = False
@@ -72,78 +345,111 @@ class Connection(object):
             self.connected = False
 
 
+    def send_stream(self, chunks):
+        """
+        Envía al cliente una respuesta producida de a partes por el iterable
+        chunks (de bytes), sin armarla completa en memoria: el iterable se
+        encola y flush lo consume a medida que el socket acepta datos.
+
+        Parámetros:
+          - self: La instancia de la clase Connection.
+          - chunks: Iterable de bytes a enviar, en orden.
+        """
+        self.outgoing.append(iter(chunks))
+
+
+    def send_status(self, code):
+        """
+        Envía al cliente la línea de estado del código dado, ya codificada
+        en STATUS_LINES.
+
+        Parámetros:
+          - self: La instancia de la clase Connection.
+          - code: Uno de los códigos de error_messages.
+        """
+        self._write(STATUS_LINES[code])
+
+
+    def _write(self, data):
+        """
+        Encola data para el próximo flush.
+        """
+        self.outgoing.append(data)
+
+
+    @command("quit")
     def quit(self):
         """
         Cierra la conexión con el cliente y envía un mensaje de confirmación.
         """
-        self.send(f"{CODE_OK} {error_messages[CODE_OK]}")
+        self.send_status(CODE_OK)
         self.close()
 
 
     def which_command(self, data_line):
         """
         Procesa los comandos recibidos del cliente y ejecuta la acción correspondiente.
+        El comando se busca en COMMANDS y sus argumentos se validan antes
+        de llamar al método que lo atiende.
 
         Parámetros:
           - self: La instancia de la clase Connection.
           - data_line: La línea de datos recibida del cliente.
         """
+        started = time.perf_counter()
+        if self.request_started is None:
+            self.request_started = time.monotonic()
+        verb, *args = data_line.split(" ")
+        name = verb.lower()
         try:
-            command, *args = data_line.split(" ")
-            if command.lower() == "quit": 
-                if len(args) == 0:
-                    self.quit()
-                else:
-                    self.send(f"{INVALID_ARGUMENTS} {error_messages[INVALID_ARGUMENTS]}")
-            
-            elif command.lower() == "get_file_listing":
-                if len(args) == 0:
-                    self.get_file_listing()
-                else:
-                    self.send(f"{INVALID_ARGUMENTS} {error_messages[INVALID_ARGUMENTS]}")
-            
-            elif command.lower() == "get_metadata":
-                if len(args) == 1:
-                    self.get_metadata(args[0])
-                else:
-                    self.send(f"{INVALID_ARGUMENTS} {error_messages[INVALID_ARGUMENTS]}")
-            
-            elif command.lower() == "get_slice":
-                try:
-                    if len(args) == 3:
-                            self.get_slice(args[0], int(args[1]), int(args[2]))
-                    else:
-                        self.send(f"{INVALID_ARGUMENTS} {error_messages[INVALID_ARGUMENTS]}")
-                except ValueError:
-                    self.send(f"{INVALID_ARGUMENTS} {error_messages[INVALID_ARGUMENTS]}")
-            
+            entry = COMMANDS.get(name)
+            if entry is None:
+                name = "invalid"  # no se distinguen en las métricas
+                self.send_status(INVALID_COMMAND)
             else:
-                self.send(f"{INVALID_COMMAND} {error_messages[INVALID_COMMAND]}")
- 
+                parsed = entry.parse(args)
+                if parsed is None:
+                    self.send_status(INVALID_ARGUMENTS)
+                else:
+                    entry.handler(self, *parsed)
+
         except Exception:
-            print(f"Error en el manejo de la conexión: {Exception}")
-            self.send(f"{INTERNAL_ERROR} {error_messages[INTERNAL_ERROR]}")
+            logging.exception("Error en el manejo de la conexión")
+            self.send_status(INTERNAL_ERROR)
+
+        labels = (("command", name),)
+        metrics.inc("hftp_requests_total", labels=labels)
+        metrics.observe("hftp_request_duration_seconds",
+                        time.perf_counter() - started, labels)
 
 
-    def _recv(self, timeout=None):
+    def _recv(self, timeout=None, flags=0):
         """
         Recibe datos del cliente y los acumula en el buffer interno.
 
         Parámetros:
           - self: La instancia de la clase Connection.
-          - timeout: El tiempo máximo de espera para recibir datos.
+          - timeout: El tiempo máximo de espera para recibir datos (si vence
+            se lanza socket.timeout).
+          - flags: Flags de recv (p. ej. MSG_DONTWAIT).
         """
         try:
-            data = self.socket.recv(4096).decode("ascii")
-            self.buffer += data 
+            if timeout is not None:
+                self.socket.settimeout(timeout)
+            try:
+                data = self.socket.recv(4096, flags)
+            finally:
+                if timeout is not None:
+                    self.socket.settimeout(None if self.blocking else 0)
+            self.buffer.feed(data)
 
             if len(data) == 0:
                 logging.info("El server interrumpió la conexión.")
                 self.connected = False
-            
-            if len(self.buffer) >= 2**32:
-                logging.warning("El buffer ha alcanzado su capacidad máxima.")
-                self.connected = False
+            else:
+                self.last_activity = time.monotonic()
+                if self.partial_since is None:
+                    self.partial_since = self.last_activity
         
         except ConnectionResetError:
             logging.warning("No se consiguió conectar con el cliente.")
@@ -154,28 +460,267 @@ class Connection(object):
             self.connected = False
 
 
+    def flush(self):
+        """
+        Envía lo encolado en self.outgoing. Los mensajes consecutivos se
+        juntan en un único sendmsg, así una tanda de comandos pipelineados
+        se contesta con una sola llamada al sistema. En modo no bloqueante
+        envía lo que el socket acepte y devuelve False si quedó algo en la
+        cola; en modo bloqueante envía todo. Si la conexión ya fue cerrada
+        por el protocolo (p. ej. con quit), cierra el socket al terminar.
+
+        Los slices se envían de a partes y, si hay límites de ancho de
+        banda, antes de cada parte se espera lo que indiquen los baldes (en
+        modo no bloqueante no se espera: se devuelve False y el servidor
+        vuelve a llamar a flush después de resume_at, sin ocupar mientras
+        tanto el hilo o el event loop).
+
+        Con quantum, cada llamada es un turno de deficit round robin: se
+        envían partes mientras quede crédito (quantum más lo que sobró o
+        faltó del turno anterior) y se devuelve False aunque el modo sea
+        bloqueante, para que el servidor atienda a otras conexiones antes
+        de seguir. Los mensajes cortos no gastan crédito.
+
+        Una PendingReply se envía cuando termina de calcularse: en modo
+        bloqueante se la espera, y en modo no bloqueante se devuelve False
+        (el servidor vuelve a atender la conexión cuando termina el
+        cálculo; ver self.wakeup).
+
+        Parámetros:
+          - self: La instancia de la clase Connection.
+        """
+        if self.quantum is not None:
+            self.deficit = min(self.deficit + self.quantum, self.quantum)
+        try:
+            while self.outgoing:
+                message = self.outgoing[0]
+                if isinstance(message, FileRegion):
+                    if not self._may_send_part():
+                        return False
+                    started = time.perf_counter()
+                    sent = message.send_to(
+                        self.socket,
+                        SLICE_CHUNK_SIZE if self.limiters or self.quantum
+                        else None)
+                    self._count_sent(sent, started)
+                    self._charge(sent)
+                    self.last_activity = time.monotonic()
+                    if message.remaining <= 0:
+                        message.close()
+                        self.outgoing.popleft()
+                    continue
+                if isinstance(message, PendingReply):
+                    if not message.ready() and not self.blocking:
+                        return False
+                    self.outgoing[0] = message.data()
+                    continue
+                if not isinstance(message, (bytes, memoryview)):
+                    if not self._may_send_part():
+                        return False
+                    self._charge(self._expand_stream())
+                    continue
+                started = time.perf_counter()
+                sent = self._send_batch()
+                self._count_sent(sent, started)
+                self._consume(sent)
+                self.last_activity = time.monotonic()
+        except BlockingIOError:
+            return False
+        except (BrokenPipeError, ConnectionResetError):
+            logging.error("Error al enviar el mensaje: conexión perdida")
+            self.drop_outgoing()
+            self.connected = False
+
+        self.deficit = 0
+        self.request_started = None
+        if not self.connected:
+            self._close_socket()
+        return True
+
+
+    def waiting_reply(self):
+        """
+        Indica si lo próximo a enviar es una PendingReply que todavía no
+        terminó de calcularse.
+        """
+        return bool(self.outgoing) and \
+            isinstance(self.outgoing[0], PendingReply) and \
+            not self.outgoing[0].ready()
+
+
+    def _expand_stream(self):
+        """
+        Saca partes del iterador que está al frente de la cola (ver
+        send_stream), hasta juntar SLICE_CHUNK_SIZE bytes, y las pone
+        adelante. Si el iterador se terminó lo quita. Devuelve la cantidad
+        de bytes que sacó.
+        """
+        started = time.perf_counter()
+        stream = self.outgoing.popleft()
+        chunks = []
+        size = 0
+        for chunk in stream:
+            chunks.append(chunk)
+            size += len(chunk)
+            if size >= SLICE_CHUNK_SIZE:
+                self.outgoing.appendleft(stream)
+                break
+        self.outgoing.extendleft(reversed(chunks))
+        metrics.inc("hftp_encode_seconds_total",
+                    time.perf_counter() - started)
+        return size
+
+
+    def _count_sent(self, sent, started):
+        """
+        Registra en las métricas un envío de `sent' bytes que empezó en el
+        instante `started' (de time.perf_counter).
+        """
+        metrics.inc("hftp_bytes_sent_total", sent)
+        metrics.inc("hftp_send_seconds_total", time.perf_counter() - started)
+
+
+    def _may_send_part(self):
+        """
+        Indica si ya se puede enviar la próxima parte de un slice: hace
+        falta que quede crédito en el turno y que lo permitan los límites de
+        ancho de banda (sólo en modo bloqueante se espera hasta resume_at).
+        """
+        if self.quantum is not None and self.deficit <= 0:
+            return False
+        delay = self.resume_at - time.monotonic()
+        if delay <= 0:
+            return True
+        if self.blocking:
+            time.sleep(delay)
+            return True
+        return False
+
+
+    def _charge(self, size):
+        """
+        Descuenta del turno los bytes de slice enviados y se los cobra a los
+        baldes; si quedaron en deuda, posterga el envío de la próxima parte.
+        """
+        self.deficit -= size
+        if self.limiters and size:
+            delay = max(bucket.charge(size) for bucket in self.limiters)
+            if delay > 0:
+                self.resume_at = time.monotonic() + delay
+
+
+    def _send_batch(self):
+        """
+        Envía con un único sendmsg los mensajes consecutivos del frente de
+        la cola. Devuelve la cantidad de bytes enviados.
+        """
+        batch = []
+        for message in self.outgoing:
+            if not isinstance(message, (bytes, memoryview)) or \
+                    len(batch) == IOV_MAX:
+                break
+            batch.append(message)
+        if len(batch) == 1 or not hasattr(self.socket, "sendmsg"):
+            return self.socket.send(b"".join(batch))
+        return self.socket.sendmsg(batch)
+
+
+    def _consume(self, sent):
+        """
+        Quita de la cola los primeros `sent' bytes ya enviados.
+        """
+        while sent > 0:
+            message = self.outgoing[0]
+            if len(message) > sent:
+                self.outgoing[0] = memoryview(message)[sent:]
+                return
+            sent -= len(message)
+            self.outgoing.popleft()
+
+
+    def drop_outgoing(self):
+        """
+        Descarta lo encolado para enviar, liberando los archivos abiertos.
+        """
+        for message in self.outgoing:
+            if isinstance(message, FileRegion):
+                message.close()
+        self.outgoing.clear()
+
+
+    def _next_line(self):
+        """
+        Extrae del buffer la próxima línea completa, sin el terminador y sin
+        espacios al principio y al final. Devuelve None si todavía no llegó
+        una línea completa. Una línea de más de max_line bytes (completa o
+        no) es un pedido malformado y cierra la conexión.
+        """
+        line = self.buffer.next_line()
+        if line is None:
+            if len(self.buffer) == 0:
+                self.partial_since = None
+            elif len(self.buffer) > self.max_line:
+                self._reject_line()
+            return None
+        self.partial_since = time.monotonic() if len(self.buffer) else None
+        if len(line) > self.max_line:
+            self._reject_line()
+            return None
+        try:
+            return line.decode("ascii").strip()
+        except UnicodeDecodeError:
+            # HFTP es un protocolo ASCII: es un pedido malformado (fatal).
+            self.send_status(BAD_REQUEST)
+            self.close()
+            return None
+
+
+    def _reject_line(self):
+        """
+        Responde BAD_REQUEST a una línea demasiado larga y cierra.
+        """
+        logging.warning("Línea de más de %d bytes, se cierra la conexión"
+                        % self.max_line)
+        self.buffer = LineBuffer()
+        self.partial_since = None
+        self.send_status(BAD_REQUEST)
+        self.close()
+
+
     def read_line(self, timeout=None):
         """
         Espera a recibir una línea completa del cliente. Devuelve la línea, 
         eliminando el terminador y los espacios en blanco al principio y al final.
+        Si pasan más de timeout segundos sin que se complete devuelve None.
 
         Parámetros:
           - self: La instancia de la clase Connection.
           - timeout: El tiempo máximo de espera para recibir datos.
         """
-        # Mientras no haya un EOL en el buffer y la conexión esté activa.
-        while not EOL in self.buffer and self.connected:
-            self._recv()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        # Mientras no haya una línea completa y la conexión esté activa.
+        line = self._next_line()
+        while line is None and self.connected:
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+            try:
+                self._recv(remaining)
+            except socket.timeout:
+                return None
+            line = self._next_line()
         
-        if EOL in self.buffer:
-            response, self.buffer = self.buffer.split(EOL, 1) 
-            return response.strip()
+        if line is not None:
+            return line
 
         else:
             self.connected = False 
             return ""
 
 
+    @command("get_file_listing")
     def get_file_listing(self):
         """
         Devuelve una lista de los archivos en el directorio que se está sirviendo.
@@ -183,15 +728,11 @@ class Connection(object):
         Parámetros:
           - self: La instancia de la clase Connection.
         """
-        print("Request: get_file_listing")
-        response = ""
-
-        for file in os.listdir(self.directory):
-            response += file + EOL
-        self.send(f"{CODE_OK} {error_messages[CODE_OK]}")
-        self.send(response)
+        self.send_status(CODE_OK)
+        self._write(self.index.listing_bytes())
 
 
+    @command("get_metadata", str)
     def get_metadata(self, filename: str):
         """
         Devuelve el tamaño de un archivo (filename) en bytes.
@@ -200,16 +741,46 @@ class Connection(object):
           - self: La instancia de la clase Connection.
           - filename: El nombre del archivo del que se quiere obtener la metadata.
         """
-        print("Request: get_metadata")
-        file_path = os.path.join(self.directory, filename)
-        if (not os.path.isfile(file_path)):
-            self.send(f"{FILE_NOT_FOUND} {error_messages[FILE_NOT_FOUND]}")
+        file_size = self.index.size(filename)
+        if file_size is None:
+            self.send_status(FILE_NOT_FOUND)
         else:
-            file_size = os.path.getsize(file_path)
-            self.send(f"{CODE_OK} {error_messages[CODE_OK]}")
+            self.send_status(CODE_OK)
             self.send(str(file_size))
 
 
+    @command("get_metadata_many", str, variadic=True)
+    def get_metadata_many(self, filenames):
+        """
+        Devuelve en una sola respuesta el tamaño de varios archivos: una
+        línea "nombre tamaño" por cada archivo que existe, en el orden
+        pedido, y una línea vacía al final. Los que no existen se omiten.
+
+        Parámetros:
+          - self: La instancia de la clase Connection.
+          - filenames: Los nombres de los archivos.
+        """
+        self.send_status(CODE_OK)
+        lines = [f"{name} {size}{EOL}"
+                 for name, size in self.index.sizes_of(filenames)]
+        lines.append(EOL)
+        self._write("".join(lines).encode("ascii"))
+
+
+    @command("get_file_listing_with_sizes")
+    def get_file_listing_with_sizes(self):
+        """
+        Como get_file_listing, pero sólo con los archivos regulares y con
+        su tamaño: una línea "nombre tamaño" por archivo.
+
+        Parámetros:
+          - self: La instancia de la clase Connection.
+        """
+        self.send_status(CODE_OK)
+        self._write(self.index.sized_listing_bytes())
+
+
+    @command("get_slice", str, int, int)
     def get_slice(self, filename:str, offset: int, size: int):
         """
         Devuelve un slice del archivo especificado por filename, comenzando en el offset
@@ -221,35 +792,479 @@ class Connection(object):
           - offset: La posición inicial del slice.
           - size: El tamaño del slice.
         """
-        print("Request: get_slice")
         file_path = os.path.join(self.directory, filename)
-        file_size = os.path.getsize(file_path)
-        if (offset < 0 and size < 0) or offset + size > file_size: 
-            self.send(f"{BAD_OFFSET}, {error_messages[BAD_OFFSET]}")
-        
+        file_size = self.index.size(filename)
+        if file_size is None:
+            self.send_status(FILE_NOT_FOUND)
+            return
+        if offset < 0 or size < 0 or offset + size > file_size:
+            self.send_status(BAD_OFFSET)
+            return
+
+        # El archivo se abre antes de encolar la línea de estado: si no se
+        # puede, la respuesta es sólo el error. Lo que se encola después
+        # sólo lee del OpenFile.
+        opened = self._open_file(file_path)
+        if opened is None:
+            self.send_status(FILE_NOT_FOUND)
+
+        elif self.mode == "binary":
+            self.send_status(CODE_OK)
+            self.send(str(size))
+            self.send_file(FileRegion(opened, offset, size))
+
+        elif self.mode == "zlib":
+            self.send_status(CODE_OK)
+            self.send_stream(self._compressed_chunks(file_path, offset, size,
+                                                     opened))
+
         else:
-            data_slice = ""
-            with open(file_path, "rb") as fn:
-                fn.seek(offset)
-                data_slice = fn.read(size)
-                self.send(f"{CODE_OK} {error_messages[CODE_OK]}")
-                self.send(data_slice, codif="b64encode")
+            self.send_status(CODE_OK)
+            if self.cache is not None:
+                chunks = self._cached_slice_chunks(file_path, offset, size,
+                                                   opened)
+            else:
+                chunks = self._slice_chunks(file_path, offset, size, opened)
+            self.send_stream(chunks)
 
 
-    def handle(self):
+    @command("get_slices", str, int, variadic=True)
+    def get_slices(self, filename: str, numbers):
         """
-        Maneja la conexión con el cliente, esperando comandos y respondiendo a los mismos.
+        Devuelve en una sola respuesta varios slices del archivo, pedidos
+        como pares offset tamaño. Después de la línea de estado va cada
+        fragmento, en el orden pedido, tal como lo enviaría get_slice en el
+        modo de transferencia de la conexión. Los rangos que se superponen
+        o son contiguos se leen juntos (ver coalesce_ranges).
+
+        Parámetros:
+          - self: La instancia de la clase Connection.
+          - filename: El nombre del archivo del que se quieren los slices.
+          - numbers: Los offsets y tamaños, alternados.
+        """
+        if len(numbers) % 2:
+            self.send_status(INVALID_ARGUMENTS)
+            return
+        ranges = list(zip(numbers[0::2], numbers[1::2]))
+        file_size = self.index.size(filename)
+        if file_size is None:
+            self.send_status(FILE_NOT_FOUND)
+            return
+        if any(offset < 0 or size < 0 or offset + size > file_size
+               for offset, size in ranges):
+            self.send_status(BAD_OFFSET)
+            return
+        spans, places = coalesce_ranges(ranges)
+        if sum(end - start for start, end in spans) > MAX_SLICES_BYTES:
+            self.send_status(INVALID_ARGUMENTS)
+            return
+        # El archivo se abre antes de la línea de estado, como en get_slice.
+        opened = self._open_file(os.path.join(self.directory, filename))
+        if opened is None:
+            self.send_status(FILE_NOT_FOUND)
+            return
+        self.send_status(CODE_OK)
+        self.send_stream(self._ranges_chunks(opened, ranges, spans, places,
+                                             self.mode))
+
+
+    @command("get_checksum", str, int, int, optional=2)
+    def get_checksum(self, filename: str, offset: int = None,
+                     size: int = None):
+        """
+        Devuelve la suma de verificación del archivo, o de size bytes desde
+        offset: una línea "algoritmo suma-en-hexadecimal". Las sumas de los
+        archivos grandes se calculan en otro hilo (ver checksum.Checksums)
+        y la respuesta se envía cuando están listas.
 
         Parámetros:
           - self: La instancia de la clase Connection.
+          - filename: El nombre del archivo.
+          - offset, size: El rango, o ninguno para el archivo completo.
         """
-        data_line = ""
-    
+        if (offset is None) != (size is None):
+            self.send_status(INVALID_ARGUMENTS)
+            return
+        file_size = self.index.size(filename)
+        if file_size is None:
+            self.send_status(FILE_NOT_FOUND)
+            return
+        if offset is None:
+            offset, size = 0, None
+        elif offset < 0 or size < 0 or offset + size > file_size:
+            self.send_status(BAD_OFFSET)
+            return
+        future = self.checksums.digest(os.path.join(self.directory,
+                                                    filename), offset, size)
+        prefix = STATUS_LINES[CODE_OK] + \
+            self.checksums.algorithm.encode("ascii") + b" "
+        self.outgoing.append(PendingReply(
+            future, lambda digest: prefix + digest.encode("ascii") +
+            EOL_BYTES))
+        if self.wakeup is not None and not future.done():
+            future.add_done_callback(lambda _: self.wakeup(self))
+
+
+    @command("set_mode", transfer_mode)
+    def set_mode(self, mode: str):
+        """
+        Elige el modo de transferencia de get_slice para esta conexión:
+        "base64" (el del protocolo original), "binary", en el que la
+        respuesta es una línea con el tamaño seguida de los bytes crudos, o
+        "zlib", en el que el slice se envía comprimido (ver
+        _compressed_chunks).
+
+        Parámetros:
+          - self: La instancia de la clase Connection.
+          - mode: Uno de TRANSFER_MODES.
+        """
+        self.mode = mode
+        self.send_status(CODE_OK)
+
+
+    def expired(self, now, idle_timeout, read_timeout, request_timeout):
+        """
+        Devuelve el motivo ("idle", "read" o "request") por el que la
+        conexión superó alguno de los límites de tiempo (en segundos, 0 es
+        sin límite) al instante now, o None si no superó ninguno.
+
+        Parámetros:
+          - self: La instancia de la clase Connection.
+          - now: El instante actual, de time.monotonic.
+          - idle_timeout, read_timeout, request_timeout: Ver Reaper.
+        """
+        if idle_timeout and now - self.last_activity > idle_timeout:
+            return "idle"
+        partial_since = self.partial_since
+        if read_timeout and partial_since is not None and \
+                now - partial_since > read_timeout:
+            return "read"
+        request_started = self.request_started
+        if request_timeout and request_started is not None and \
+                now - request_started > request_timeout:
+            return "request"
+        return None
+
+
+    def abort(self):
+        """
+        Corta la conexión desde otro hilo (p. ej. el Reaper): con shutdown
+        se despierta al hilo o al event loop que la atiende, que ve la
+        conexión cerrada y libera sus recursos.
+        """
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass  # Ya estaba cerrada
+
+
+    @command("stats")
+    def stats(self):
+        """
+        Devuelve las métricas del proceso que atiende la conexión, en el
+        formato de texto de Prometheus: una línea por muestra y una línea
+        vacía al final.
+
+        Parámetros:
+          - self: La instancia de la clase Connection.
+        """
+        self.send_status(CODE_OK)
+        lines = metrics.render()
+        lines.append("")
+        self._write(EOL.join(lines).encode("ascii") + EOL_BYTES)
+
+
+    def send_file(self, region):
+        """
+        Envía crudo un rango de un archivo. Se encola el FileRegion, que
+        flush copia del archivo al socket dentro del kernel.
+
+        Parámetros:
+          - self: La instancia de la clase Connection.
+          - region: El FileRegion, con el archivo ya abierto.
+        """
+        self.outgoing.append(region)
+
+
+    def _open_file(self, file_path):
+        """
+        Devuelve el OpenFile del que se leen los slices del archivo: el del
+        cache de archivos abiertos, o sin cache, uno abierto sólo para este
+        pedido. Devuelve None si no es un archivo regular; si no se puede
+        abrir genera una excepción OSError.
+
+        Parámetros:
+          - self: La instancia de la clase Connection.
+          - file_path: Ruta del archivo.
+        """
+        if self.files is not None:
+            return self.files.get(file_path)
+        return open_file(file_path)
+
+
+    def _slice_chunks(self, file_path, offset: int, size: int, opened):
+        """
+        Generador que lee el slice de a SLICE_CHUNK_SIZE bytes sobre un único
+        buffer reutilizado y devuelve cada parte codificada en base64,
+        terminando con el EOL. Como SLICE_CHUNK_SIZE es múltiplo de 3, la
+        concatenación de las partes es la codificación del slice completo, y
+        la memoria usada no depende del tamaño pedido. Si el archivo se
+        achica mientras se lee, el slice se corta donde termina.
+
+        Parámetros:
+          - self: La instancia de la clase Connection.
+          - file_path: Ruta del archivo.
+          - offset: La posición inicial del slice.
+          - size: El tamaño del slice.
+          - opened: El OpenFile del archivo.
+        """
+        fd = opened.fd
+        view = memoryview(bytearray(SLICE_CHUNK_SIZE))
+        pos = offset
+        end = offset + size
+        while pos < end:
+            wanted = min(end - pos, SLICE_CHUNK_SIZE)
+            read = 0
+            # preadv puede leer menos de lo pedido; completamos la parte
+            # para no romper la alineación de a 3 bytes.
+            while read < wanted:
+                n = _preadv(fd, view[read:wanted], pos + read)
+                if not n:
+                    break
+                read += n
+            if read == 0:
+                break
+            pos += read
+            yield b2a_base64(view[:read], newline=False)
+            if read < wanted:
+                break
+        yield EOL_BYTES
+
+
+    def _compressed_chunks(self, file_path, offset: int, size: int, opened):
+        """
+        Generador que comprime el slice con zlib a medida que lo lee y lo
+        devuelve en pedazos "<largo>\r\n<bytes comprimidos>", terminando
+        con un pedazo vacío "0\r\n". Con cache, el resultado se guarda y
+        los pedidos siguientes del mismo slice no vuelven a comprimir.
+
+        Parámetros:
+          - self: La instancia de la clase Connection.
+          - file_path: Ruta del archivo.
+          - offset: La posición inicial del slice.
+          - size: El tamaño del slice.
+          - opened: El OpenFile del archivo.
+        """
+        level = self.compress_level
+        fd = opened.fd
+        if self.cache is not None:
+            stamp = self.cache.stamp(file_path, opened.st)
+            data = self.cache.compressed_slice(file_path, stamp, offset,
+                                               size, level)
+            if data is not None:
+                if data:
+                    yield b"%d%s" % (len(data), EOL_BYTES)
+                    yield data
+                yield b"0" + EOL_BYTES
+                return
+            kept = []
+            kept_size = 0
+        else:
+            kept = None
+        compressor = zlib.compressobj(level)
+        pos = offset
+        end = offset + size
+        while True:
+            raw = os.pread(fd, min(SLICE_CHUNK_SIZE, end - pos), pos) \
+                if pos < end else b""
+            pos += len(raw)
+            data = compressor.compress(raw) if raw else compressor.flush()
+            if data:
+                yield b"%d%s" % (len(data), EOL_BYTES)
+                yield data
+                if kept is not None:
+                    kept.append(data)
+                    kept_size += len(data)
+                    if kept_size > COMPRESS_CACHE_MAX:
+                        kept = None
+            if not raw:
+                break
+        if kept is not None:
+            self.cache.put_compressed(file_path, stamp, offset, size, level,
+                                      b"".join(kept))
+        yield b"0" + EOL_BYTES
+
+
+    def _cached_slice_chunks(self, file_path, offset: int, size: int,
+                             opened):
+        """
+        Como _slice_chunks, pero leyendo los bloques del BlockCache. Si el
+        slice arranca en una posición múltiplo de 3 se envían directamente
+        pedazos de los bloques ya codificados, sin leer ni codificar nada;
+        si no, se codifican los bloques crudos arrastrando entre uno y otro
+        los bytes que no completan un grupo de 3.
+
+        Parámetros:
+          - self: La instancia de la clase Connection.
+          - file_path: Ruta del archivo.
+          - offset: La posición inicial del slice.
+          - size: El tamaño del slice.
+          - opened: El OpenFile del archivo.
+        """
+        cache = self.cache
+        block_size = cache.block_size
+        fd = opened.fd
+        st = opened.st
+        stamp = cache.stamp(file_path, st)
+        pos = offset
+        end = min(offset + size, st.st_size)
+        carry = b""
+        while pos < end:
+            index = pos // block_size
+            block_start = index * block_size
+            block_len = min(block_size, st.st_size - block_start)
+            a = pos - block_start
+            b = min(end - block_start, block_len)
+            if not carry and a % 3 == 0 and \
+                    (b % 3 == 0 or b == block_len):
+                encoded = cache.encoded_block(fd, file_path, stamp, index)
+                yield memoryview(encoded)[a // 3 * 4:-(-b // 3) * 4]
+            else:
+                raw = cache.raw_block(fd, file_path, stamp, index)
+                data = carry + raw[a:b]
+                if block_start + b < end:
+                    cut = len(data) - len(data) % 3
+                    data, carry = data[:cut], data[cut:]
+                yield b2a_base64(data, newline=False)
+            pos = block_start + b
+        yield EOL_BYTES
+
+
+    def _ranges_chunks(self, opened, ranges, spans, places, mode):
+        """
+        Generador de la respuesta de get_slices: lee cada tramo con un solo
+        os.preadv sobre un buffer propio y devuelve los fragmentos de los
+        rangos, que son pedazos de esos buffers, codificados en el modo
+        dado.
+
+        Parámetros:
+          - self: La instancia de la clase Connection.
+          - opened: El OpenFile del archivo.
+          - ranges: Los pares (offset, tamaño) pedidos.
+          - spans, places: Los tramos a leer y dónde está cada rango (ver
+            coalesce_ranges).
+          - mode: El modo de transferencia al momento del pedido.
+        """
+        views = []
+        fd = opened.fd
+        for start, end in spans:
+            view = memoryview(bytearray(end - start))
+            read = 0
+            # Si el archivo se achicó, el tramo queda incompleto.
+            while read < len(view):
+                n = _preadv(fd, view[read:], start + read)
+                if not n:
+                    break
+                read += n
+            views.append(view[:read])
+        for (offset, size), (span, position) in zip(ranges, places):
+            data = views[span][position:position + size]
+            if mode == "binary":
+                yield b"%d%s" % (len(data), EOL_BYTES)
+                if data:
+                    yield data
+            elif mode == "zlib":
+                yield from self._compressed_frames(data)
+            else:
+                for pos in range(0, len(data), SLICE_CHUNK_SIZE):
+                    yield b2a_base64(data[pos:pos + SLICE_CHUNK_SIZE],
+                                     newline=False)
+                yield EOL_BYTES
+
+
+    def _compressed_frames(self, data):
+        """
+        Generador que comprime data (ya en memoria) con zlib y lo devuelve
+        en el formato de _compressed_chunks.
+
+        Parámetros:
+          - self: La instancia de la clase Connection.
+          - data: Los bytes del slice.
+        """
+        compressor = zlib.compressobj(self.compress_level)
+        for pos in range(0, len(data), SLICE_CHUNK_SIZE):
+            yield from _frame(
+                compressor.compress(data[pos:pos + SLICE_CHUNK_SIZE]))
+        yield from _frame(compressor.flush())
+        yield b"0" + EOL_BYTES
+
+
+    def handle_line(self, data_line):
+        """
+        Atiende una línea recibida del cliente: reporta BAD_EOL si contiene un
+        \n suelto y, si no está vacía, la despacha como comando.
+
+        Parámetros:
+          - self: La instancia de la clase Connection.
+          - data_line: La línea recibida, sin el terminador.
+        """
+        if "\n" in data_line:
+            self.send_status(BAD_EOL)
+
+        elif len(data_line) > 0:
+            self.which_command(data_line)
+
+
+    def on_readable(self):
+        """
+        Lo llama el event loop del servidor cuando el socket tiene datos:
+        recibe lo disponible y atiende todas las líneas completas.
+
+        Parámetros:
+          - self: La instancia de la clase Connection.
+        """
+        try:
+            self._recv()
+        except BlockingIOError:
+            return
         while self.connected:
-            if "\n" in data_line:
-                self.send(f"{BAD_EOL} {error_messages[BAD_EOL]}")
+            data_line = self._next_line()
+            if data_line is None:
+                break
+            self.handle_line(data_line)
+
 
-            elif len(data_line) > 0:
-                self.which_command(data_line)
-            data_line = self.read_line()
-            
\ No newline at end of file
+    def handle(self, park=False):
+        """
+        Maneja la conexión con el cliente, esperando comandos y respondiendo a los mismos.
+        Atiende en orden todos los comandos completos que haya en el buffer
+        y recién después envía sus respuestas, todas juntas.
+
+        Devuelve True cuando la conexión terminó. Con quantum, devuelve
+        False al agotar su turno con datos por enviar; con park, también
+        cuando tendría que bloquearse esperando datos del cliente, y en modo
+        no bloqueante, cuando flush no pudo terminar de enviar (ver flush).
+        En todos los casos hay que volver a llamarla más tarde (ver
+        Server._set_aside) y continúa donde quedó.
+
+        Parámetros:
+          - self: La instancia de la clase Connection.
+          - park: No bloquearse esperando comandos.
+        """
+        while self.connected:
+            data_line = self._next_line()
+            while data_line is not None and self.connected:
+                self.handle_line(data_line)
+                data_line = self._next_line()
+            if self.outgoing and not self.flush():
+                return False
+            if self.connected:
+                if not park:
+                    self._recv()
+                    continue
+                try:
+                    self._recv(flags=socket.MSG_DONTWAIT if self.blocking
+                               else 0)
+                except BlockingIOError:
+                    return False
+        return self.flush()
@@ -8,14 +8,94 @@
 DEFAULT_DIR = 'testdata'
 DEFAULT_ADDR = '0.0.0.0'  # 0.0.0.0 representa todas las IPv4 del server
 DEFAULT_PORT = 19500
+DEFAULT_ENGINE = 'threads'
+ENGINES = ('threads', 'async')  # hilo por conexión / event loop con selectors
+DEFAULT_MAX_WORKERS = 32     # hilos que atienden conexiones
+DEFAULT_MAX_QUEUED = 64      # conexiones aceptadas esperando un hilo libre
+DEFAULT_MAX_CONNECTIONS = 0  # conexiones abiertas a la vez (0: sin límite)
+DEFAULT_LISTEN_BACKLOG = 128  # conexiones sin aceptar en el kernel
+SHUTDOWN_TIMEOUT = 10  # segundos para terminar las conexiones al detenerse
+ACCEPT_POLL_INTERVAL = 0.5  # cada cuánto se revisa si hay que detenerse
+RESPAWN_BACKOFF = 1  # espera antes de relanzar un proceso que murió al nacer
+INDEX_POLL_INTERVAL = 1.0  # relectura del directorio si no hay inotify
 
 
 EOL = '\r\n'
 
+# Los slices se leen y codifican de a partes de este tamaño. Debe ser
+# múltiplo de 3 para que base64 no agregue relleno entre partes.
+SLICE_CHUNK_SIZE = 3 * 2**14
+
+# Bloques del cache de archivos (múltiplo de 3, como SLICE_CHUNK_SIZE),
+# presupuesto por defecto del cache, en bytes, y cantidad de archivos de los
+# que recuerda la última versión vista.
+CACHE_BLOCK_SIZE = SLICE_CHUNK_SIZE
+DEFAULT_CACHE_SIZE = 64 * 2**20
+CACHE_MAX_STAMPS = 4096
+
+# Archivos que mantiene abiertos cada proceso para leer los slices sin
+# abrirlos en cada pedido.
+DEFAULT_OPEN_FILES = 64
+
+# Bytes que puede pedir un get_slices entre todos sus rangos, una vez
+# combinados los que se superponen (se leen enteros a memoria).
+MAX_SLICES_BYTES = 16 * 2**20
+
+# Sumas de verificación de get_checksum: algoritmo de hashlib, hilos que
+# calculan las de más de CHECKSUM_INLINE_MAX bytes (las demás se calculan
+# en el momento), sumas guardadas por proceso y tamaño de cada lectura.
+CHECKSUM_ALGORITHM = 'sha256'
+DEFAULT_CHECKSUM_WORKERS = 2
+CHECKSUM_INLINE_MAX = 2**20
+CHECKSUM_CACHE_ENTRIES = 4096
+CHECKSUM_CHUNK_SIZE = 2**20
+
+# Descargas de a pedazos del cliente: tamaño de cada pedazo y sufijo del
+# registro de pedazos terminados que permite retomarlas.
+DOWNLOAD_CHUNK_SIZE = 4 * 2**20
+RECV_SIZE = 2**16  # máximo de bytes por recv del cliente
+JOURNAL_SUFFIX = '.hftp-journal'
+
+# Pool de conexiones del cliente asyncio: conexiones abiertas a la vez,
+# segundos sin uso tras los que una conexión libre se cierra y tras los que
+# se verifica que siga viva antes de reusarla.
+DEFAULT_POOL_SIZE = 8
+POOL_IDLE_TIMEOUT = 60
+POOL_CHECK_AFTER = 5
+
+# Modos de transferencia de get_slice, elegidos por conexión con set_mode.
+TRANSFER_MODES = ('base64', 'binary', 'zlib')
+
+# Nivel de compresión por defecto del modo zlib (1: rápido, 9: máximo) y
+# tamaño máximo de un slice comprimido que se guarda en el cache.
+DEFAULT_COMPRESS_LEVEL = 6
+COMPRESS_CACHE_MAX = 4 * 2**20
+
+# Límites de ancho de banda de los slices, en bytes por segundo, por
+# conexión y para todo el proceso (0: sin límite).
+DEFAULT_RATE_LIMIT = 0
+DEFAULT_GLOBAL_RATE_LIMIT = 0
+
+# Bytes de slices que envía una conexión en cada turno antes de ceder el
+# lugar a las demás (deficit round robin; 0: sin turnos).
+DEFAULT_QUANTUM = 2**18
+
+# Límites de cada conexión, en segundos (0: sin límite): sin actividad, para
+# completar una línea ya empezada y para terminar de enviar la respuesta a
+# un pedido. Las vencidas las cierra el Reaper, que revisa cada
+# REAPER_INTERVAL segundos. Una línea más larga que DEFAULT_MAX_LINE bytes
+# es un pedido malformado.
+DEFAULT_IDLE_TIMEOUT = 300
+DEFAULT_READ_TIMEOUT = 30
+DEFAULT_REQUEST_TIMEOUT = 0
+REAPER_INTERVAL = 1.0
+DEFAULT_MAX_LINE = 8 * 2**20
+
 
 CODE_OK = 0
 BAD_EOL = 100
 BAD_REQUEST = 101
+SERVER_BUSY = 102
 INTERNAL_ERROR = 199
 INVALID_COMMAND = 200
 INVALID_ARGUMENTS = 201
@@ -28,6 +108,7 @@ error_messages = {
     # 1xx: Errores fatales (no se pueden atender más pedidos)
     BAD_EOL: "BAD EOL",
     BAD_REQUEST: "BAD REQUEST",
+    SERVER_BUSY: "SERVER BUSY",
     INTERNAL_ERROR: "INTERNAL SERVER ERROR",
     # 2xx: Errores no fatales (no se pudo atender este pedido)
     INVALID_COMMAND: "NO SUCH COMMAND",
@@ -46,6 +127,12 @@ def fatal_status(s):
     return 100 <= s < 200
 
 
+# Líneas de estado ("código mensaje" con el terminador) ya codificadas, para
+# no armarlas en cada respuesta.
+STATUS_LINES = {code: ("%d %s%s" % (code, message, EOL)).encode("ascii")
+                for code, message in error_messages.items()}
+
+
 VALID_CHARS = set(".-_")
 for i in range(ord('A'), ord('Z') + 1):
     VALID_CHARS.add(chr(i))
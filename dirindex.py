@@ -0,0 +1,334 @@
+# encoding: utf-8
+# Índice en memoria del directorio compartido por el servidor.
+
+import ctypes
+import ctypes.util
+import fcntl
+import logging
+import os
+import stat
+import struct
+import termios
+import threading
+import time
+from constants import *
+
+# Constantes de <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+              IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+              IN_MOVE_SELF)
+# Eventos tras los cuales el watch deja de servir y hay que releer todo.
+RESCAN_EVENTS = IN_DELETE_SELF | IN_MOVE_SELF | IN_Q_OVERFLOW | IN_IGNORED
+
+EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+INT = struct.Struct("i")
+
+
+class Inotify(object):
+    """
+    Watch de inotify (Linux) sobre un directorio, con el descriptor en modo
+    no bloqueante. Lanza OSError si inotify no está disponible. El
+    descriptor se cierra con close o cuando nadie usa más el Inotify.
+    """
+
+    libc = None
+
+    def __init__(self, path):
+        self.fd = -1
+        if Inotify.libc is None:
+            name = ctypes.util.find_library("c")
+            if name is None:
+                raise OSError("No se encontró la libc")
+            Inotify.libc = ctypes.CDLL(name, use_errno=True)
+        libc = Inotify.libc
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("inotify no está disponible")
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+        wd = libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            self.close()
+            raise OSError(errno, "inotify_add_watch")
+
+    def pending(self):
+        """
+        Devuelve True si hay eventos sin leer, sin consumirlos.
+        """
+        queued = fcntl.ioctl(self.fd, termios.FIONREAD, INT.pack(0))
+        return INT.unpack(queued)[0] > 0
+
+    def read_events(self):
+        """
+        Devuelve los eventos pendientes como una lista de pares
+        (máscara, nombre), sin bloquear.
+        """
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 2**16)
+            except BlockingIOError:
+                return events
+            pos = 0
+            while pos < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, pos)
+                pos += EVENT_HEADER.size
+                name = data[pos:pos + length].rstrip(b"\0")
+                pos += length
+                events.append((mask, os.fsdecode(name)))
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def __del__(self):
+        self.close()
+
+
+class DirectoryIndex(object):
+    """
+    Listado y tamaños de los archivos del directorio, en memoria y seguros
+    para usar desde varios hilos.
+
+    Con inotify, cada consulta sólo pregunta (con una llamada al sistema y
+    sin tomar el lock) si hay eventos pendientes; si no los hay, responde
+    desde memoria. Si los hay, los lee con el lock tomado y sólo vuelve a
+    consultar los archivos que cambiaron. Además, tras un IN_DELETE o cada
+    poll_interval segundos se compara el inodo del directorio: si se lo
+    borra mientras algún archivo suyo sigue abierto (p. ej. en
+    filecache.OpenFiles), inotify no avisa hasta que ese archivo se cierra
+    y no se vería el directorio nuevo con el mismo nombre. Si inotify no
+    está disponible se relee el directorio cuando cambia su mtime o cada
+    poll_interval segundos, para notar cambios de tamaño.
+    """
+
+    def __init__(self, directory, poll_interval=INDEX_POLL_INTERVAL):
+        self.directory = directory
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.sizes = {}      # nombre -> tamaño, sólo archivos regulares
+        self.names = []      # todas las entradas, en el orden de scandir
+        self.listing = b""   # cuerpo serializado de get_file_listing
+        self.sized_listing = None  # ídem con tamaños; None: hay que armarlo
+        self.watcher = None
+        self.dir_stamp = None
+        self.scanned_at = 0
+        self.inode_check_at = 0  # próxima revisión del inodo del directorio
+        self._watch()
+        self._rescan()
+
+    def listing_bytes(self):
+        """
+        Devuelve el cuerpo de la respuesta a get_file_listing: un nombre
+        por línea y una línea vacía al final.
+        """
+        self._refresh()
+        with self.lock:
+            return self.listing
+
+    def size(self, name):
+        """
+        Devuelve el tamaño del archivo `name', o None si no es un archivo
+        del directorio.
+        """
+        self._refresh()
+        with self.lock:
+            return self.sizes.get(name)
+
+    def sized_listing_bytes(self):
+        """
+        Devuelve el cuerpo de la respuesta a get_file_listing_with_sizes:
+        una línea "nombre tamaño" por archivo regular y una línea vacía al
+        final.
+        """
+        self._refresh()
+        with self.lock:
+            if self.sized_listing is None:
+                lines = []
+                for name in self.names:
+                    size = self.sizes.get(name)
+                    if size is None:
+                        continue
+                    try:
+                        lines.append(b"%s %d%s" % (name.encode("ascii"), size,
+                                                   EOL.encode("ascii")))
+                    except UnicodeEncodeError:
+                        pass
+                lines.append(EOL.encode("ascii"))
+                self.sized_listing = b"".join(lines)
+            return self.sized_listing
+
+    def sizes_of(self, names):
+        """
+        Devuelve una lista de pares (nombre, tamaño) con los nombres de
+        `names' que son archivos del directorio, en el mismo orden.
+        """
+        self._refresh()
+        with self.lock:
+            sizes = self.sizes
+            return [(name, sizes[name]) for name in names if name in sizes]
+
+    def close(self):
+        # Como al reemplazar el watch en _consume, el descriptor se cierra
+        # cuando lo suelta el último hilo que lo estaba consultando.
+        with self.lock:
+            self.watcher = None
+
+    def _watch(self):
+        try:
+            self.watcher = Inotify(self.directory)
+        except OSError as e:
+            logging.info(f"Sin inotify para {self.directory} ({e}), "
+                         "se usa polling")
+            self.watcher = None
+
+    def _refresh(self):
+        """
+        Pone al día el índice. Se llama sin el lock, que sólo se toma si hay
+        algo que releer. Las consultas lo toman después para leer el
+        índice, así esperan a que se termine de aplicar un cambio cuyos
+        eventos ya leyó otro hilo.
+        """
+        watcher = self.watcher
+        if watcher is not None and not watcher.pending() and \
+                time.monotonic() < self.inode_check_at:
+            return
+        with self.lock:
+            if self.watcher is None:
+                self._poll()
+            else:
+                self._consume()
+
+    def _consume(self):
+        """
+        Lee los eventos de inotify pendientes y los aplica al índice.
+        """
+        events = self.watcher.read_events()
+        replaced = False
+        now = time.monotonic()
+        if now >= self.inode_check_at or \
+                any(mask & IN_DELETE for mask, _ in events):
+            self.inode_check_at = now + self.poll_interval
+            try:
+                inode = os.stat(self.directory).st_ino
+            except OSError:
+                inode = None
+            replaced = inode != (self.dir_stamp and self.dir_stamp[0])
+        if replaced or any(mask & RESCAN_EVENTS for mask, _ in events):
+            # El directorio fue borrado, movido o reemplazado, o se
+            # perdieron eventos: volvemos a vigilarlo desde cero. El watch
+            # viejo no se cierra acá: otro hilo puede estar consultándolo
+            # sin el lock en _refresh, y se cierra cuando lo suelta.
+            self._watch()
+            self._rescan()
+            return
+        # Los eventos del propio directorio no traen nombre.
+        dirty = set(name for _, name in events if name)
+        if dirty:
+            self._update(dirty)
+
+    def _poll(self):
+        try:
+            st = os.stat(self.directory)
+            stamp = (st.st_ino, st.st_mtime_ns)
+        except OSError:
+            stamp = None
+        if stamp != self.dir_stamp or \
+                time.monotonic() - self.scanned_at >= self.poll_interval:
+            self._rescan()
+
+    def _rescan(self):
+        """
+        Relee el directorio completo con os.scandir.
+        """
+        sizes = {}
+        names = []
+        try:
+            st = os.stat(self.directory)
+            self.dir_stamp = (st.st_ino, st.st_mtime_ns)
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    names.append(entry.name)
+                    try:
+                        if entry.is_file():
+                            sizes[entry.name] = entry.stat().st_size
+                    except OSError:
+                        pass  # Se borró mientras lo leíamos
+        except OSError:
+            self.dir_stamp = None
+        self.scanned_at = time.monotonic()
+        if sizes != self.sizes:
+            self.sizes = sizes
+            self.sized_listing = None
+        if names != self.names:
+            self._set_names(names)
+
+    def _update(self, dirty):
+        """
+        Vuelve a consultar sólo las entradas que cambiaron.
+        """
+        known = set(self.names)
+        self.sized_listing = None
+        added = []
+        removed = set()
+        for name in dirty:
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                st = None
+            if st is not None and name not in known:
+                added.append(name)
+            elif st is None and name in known:
+                removed.add(name)
+            if st is not None and stat.S_ISREG(st.st_mode):
+                self.sizes[name] = st.st_size
+            else:
+                self.sizes.pop(name, None)
+        if added or removed:
+            self._set_names([name for name in self.names
+                             if name not in removed] + added)
+
+    def _set_names(self, names):
+        self.names = names
+        lines = []
+        for name in names:
+            try:
+                lines.append(name.encode("ascii") + EOL.encode("ascii"))
+            except UnicodeEncodeError:
+                # HFTP es ASCII: esos archivos no se pueden pedir.
+                pass
+        lines.append(EOL.encode("ascii"))
+        self.listing = b"".join(lines)
+
+
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+def shared_index(directory):
+    """
+    Devuelve el DirectoryIndex del directorio compartido por todas las
+    conexiones de este proceso, creándolo la primera vez.
+    """
+    key = os.path.abspath(directory)
+    with _shared_lock:
+        index = _shared.get(key)
+        if index is None:
+            index = _shared[key] = DirectoryIndex(directory)
+        return index
@@ -0,0 +1,116 @@
+# encoding: utf-8
+# Cache de archivos abiertos, compartido por las conexiones.
+
+import os
+import stat
+import threading
+from collections import OrderedDict
+from constants import *
+
+
+class OpenFile(object):
+    """
+    Un archivo abierto para lectura. El descriptor fd se lee con os.pread u
+    os.preadv, que no mueven la posición del archivo, así varias conexiones
+    (y varios hilos) lo leen a la vez. st es el os.stat_result al momento
+    de abrirlo.
+
+    El descriptor se cierra cuando ya nadie usa el OpenFile (ni el cache ni
+    las respuestas encoladas que lo leen), no al descartarlo del cache.
+    """
+
+    __slots__ = ("path", "st", "stamp", "size", "fd")
+
+    def __init__(self, path, st, fd):
+        self.path = path
+        self.st = st
+        self.stamp = _stamp(st)
+        self.size = st.st_size
+        self.fd = fd
+
+    def __del__(self):
+        os.close(self.fd)
+
+
+def _stamp(st):
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def open_file(path):
+    """
+    Abre path para lectura, sin pasar por un cache, y devuelve su OpenFile,
+    o None si no es un archivo regular. Si no se puede abrir genera una
+    excepción OSError.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        st = os.fstat(fd)
+    except OSError:
+        os.close(fd)
+        raise
+    if not stat.S_ISREG(st.st_mode):
+        os.close(fd)
+        return None
+    return OpenFile(path, st, fd)
+
+
+class OpenFiles(object):
+    """
+    Hasta max_files archivos abiertos, para servir muchos slices de los
+    mismos archivos sin abrirlos y cerrarlos en cada pedido: basta un stat
+    para ver que el archivo no cambió. Si cambió (otro inodo, mtime o
+    tamaño) se vuelve a abrir. Cuando se excede max_files se descartan los
+    usados hace más tiempo.
+
+    Los datos se leen con pread o sendfile y no con un mapeo en memoria:
+    un archivo que se achica mientras se lee de su mapeo mata al proceso
+    con SIGBUS, mientras que pread y sendfile sólo devuelven menos bytes.
+    Es seguro para usar desde varios hilos.
+    """
+
+    def __init__(self, max_files=DEFAULT_OPEN_FILES):
+        self.max_files = max_files
+        self.files = OrderedDict()  # ruta -> OpenFile
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        """
+        Devuelve el OpenFile actualizado de path, o None si no es un
+        archivo regular. Si no existe genera una excepción OSError.
+        """
+        try:
+            stamp = _stamp(os.stat(path))
+        except OSError:
+            # Se borró: no hay que mantenerlo abierto (ni ocupando espacio
+            # en disco) hasta que lo desplacen otros archivos.
+            with self.lock:
+                self.files.pop(path, None)
+            raise
+        with self.lock:
+            opened = self.files.get(path)
+            if opened is not None and opened.stamp == stamp:
+                self.files.move_to_end(path)
+                self.hits += 1
+                return opened
+            self.misses += 1
+        opened = open_file(path)
+        with self.lock:
+            if opened is None:
+                self.files.pop(path, None)
+                return None
+            self.files[path] = opened
+            self.files.move_to_end(path)
+            while len(self.files) > self.max_files:
+                self.files.popitem(last=False)
+        return opened
+
+    def stats(self):
+        """
+        Devuelve los contadores de aciertos y fallos y los archivos
+        abiertos.
+        """
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "entries": len(self.files)}
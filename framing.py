@@ -0,0 +1,187 @@
+# encoding: utf-8
+# Framing de líneas HFTP compartido por el servidor y el cliente.
+
+import zlib
+from binascii import a2b_base64
+from constants import EOL
+
+EOL_BYTES = EOL.encode("ascii")
+EOL_LEN = len(EOL_BYTES)
+
+# Por debajo de este tamaño no vale la pena compactar el buffer.
+COMPACT_THRESHOLD = 2**16
+
+
+class LineBuffer(object):
+    """
+    Buffer de recepción que separa líneas terminadas en EOL.
+
+    Los datos se acumulan en un bytearray. Las líneas se entregan avanzando
+    un índice de inicio, sin copiar el resto del buffer, y la búsqueda del
+    EOL continúa desde donde quedó la anterior, así que cada byte se revisa
+    una sola vez aunque la línea llegue en miles de partes. La parte ya
+    consumida se descarta cuando ocupa más de la mitad del buffer.
+    """
+
+    def __init__(self):
+        self.data = bytearray()
+        self.start = 0    # comienzo de los datos sin consumir
+        self.scanned = 0  # hasta acá ya sabemos que no hay EOL
+
+    def __len__(self):
+        return len(self.data) - self.start
+
+    def feed(self, data):
+        """
+        Agrega al final los datos recibidos.
+        """
+        self.data += data
+
+    def find_eol(self):
+        """
+        Devuelve la posición (relativa a los datos sin consumir) del próximo
+        EOL, o -1 si todavía no llegó.
+        """
+        i = self.data.find(EOL_BYTES, max(self.scanned, self.start))
+        if i < 0:
+            # El último byte puede ser el '\r' de un EOL partido en dos.
+            self.scanned = max(len(self.data) - EOL_LEN + 1, self.start)
+            return -1
+        return i - self.start
+
+    def next_line(self):
+        """
+        Extrae la próxima línea completa (un bytearray), sin el terminador.
+        Devuelve None si todavía no llegó una línea completa.
+        """
+        # Es el camino más usado: find_eol, take y skip van inline.
+        data = self.data
+        start = self.start
+        scanned = self.scanned
+        i = data.find(EOL_BYTES, scanned if scanned > start else start)
+        if i < 0:
+            self.scanned = max(len(data) - EOL_LEN + 1, start)
+            return None
+        line = data[start:i]
+        self.start = i + EOL_LEN
+        if self.start >= COMPACT_THRESHOLD:
+            self._compact()
+        return line
+
+    def take(self, length):
+        """
+        Extrae y devuelve hasta `length' bytes del comienzo.
+        """
+        end = min(self.start + length, len(self.data))
+        chunk = bytes(self.data[self.start:end])
+        self.start = end
+        self._compact()
+        return chunk
+
+    def skip(self, length):
+        """
+        Descarta hasta `length' bytes del comienzo.
+        """
+        self.start = min(self.start + length, len(self.data))
+        self._compact()
+
+    def _compact(self):
+        if self.start >= COMPACT_THRESHOLD and \
+                self.start * 2 >= len(self.data):
+            del self.data[:self.start]
+            self.scanned = max(self.scanned - self.start, 0)
+            self.start = 0
+        elif self.start == len(self.data):
+            self.data.clear()
+            self.start = self.scanned = 0
+
+
+class FragmentDecoder(object):
+    """
+    Decodifica de a partes el fragmento de una respuesta a get_slice a
+    medida que llega a un LineBuffer, sin juntarlo entero en memoria.
+
+    En modo base64 se decodifica sólo lo que completa grupos de 4
+    caracteres y el resto se guarda para la próxima parte; en modo binario
+    se lee primero la línea con el tamaño y luego los bytes crudos; en modo
+    zlib llegan pedazos "<largo>\r\n<bytes>" de datos comprimidos, que se
+    descomprimen a medida que llegan, hasta un pedazo de largo 0.
+    """
+
+    def __init__(self, mode, length):
+        self.mode = mode
+        self.length = length
+        self.received = 0      # bytes decodificados hasta ahora
+        self.remaining = None  # binario: bytes que faltan (None: sin tamaño)
+        self.carry = b""
+        self.done = False
+        if mode == "zlib":
+            self.decompressor = zlib.decompressobj()
+            self.chunk = 0  # bytes que faltan del pedazo actual
+
+    def consume(self, buffer):
+        """
+        Saca del buffer todo lo que se pueda decodificar y devuelve la lista
+        de partes decodificadas. Cuando termina el fragmento pone done.
+        """
+        pieces = []
+        if self.mode == "binary":
+            if self.remaining is None:
+                line = buffer.next_line()
+                if line is None:
+                    return pieces
+                self.remaining = int(line)
+            if self.remaining and len(buffer):
+                data = buffer.take(self.remaining)
+                self.remaining -= len(data)
+                self.received += len(data)
+                pieces.append(data)
+            self.done = self.remaining == 0
+            return pieces
+
+        if self.mode == "zlib":
+            while not self.done:
+                if self.chunk == 0:
+                    line = buffer.next_line()
+                    if line is None:
+                        break
+                    self.chunk = int(line)
+                    if self.chunk == 0:
+                        data = self.decompressor.flush()
+                        self.done = True
+                    else:
+                        continue
+                else:
+                    raw = buffer.take(self.chunk)
+                    if not raw:
+                        break
+                    self.chunk -= len(raw)
+                    data = self.decompressor.decompress(raw)
+                if data:
+                    self.received += len(data)
+                    pieces.append(data)
+            return pieces
+
+        while not self.done:
+            i = buffer.find_eol()
+            if i < 0:
+                # Dejamos el último byte por si es el '\r' del terminador
+                available = len(buffer) - 1
+                if available <= 0:
+                    break
+                data = self.carry + buffer.take(available)
+                cut = len(data) - len(data) % 4
+                data, self.carry = data[:cut], data[cut:]
+            else:
+                data = self.carry + buffer.take(i)
+                self.carry = b""
+                buffer.skip(EOL_LEN)
+            if data:
+                decoded = a2b_base64(data)
+                self.received += len(decoded)
+                pieces.append(decoded)
+            if i < 0:
+                break
+            # Servidores viejos pueden partir el fragmento en varias líneas
+            self.done = self.received >= self.length
+        return pieces
@@ -0,0 +1,187 @@
+# encoding: utf-8
+# Métricas del servidor (contadores, valores e histogramas), exportadas en
+# el formato de texto de Prometheus.
+
+import logging
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Límites superiores (en segundos) de los histogramas de latencia.
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 10)
+
+# Nombre -> (tipo, descripción) de las métricas que usa el servidor. Las
+# descripciones van sin tildes: el comando stats responde en ASCII.
+DESCRIPTIONS = {
+    "hftp_connections_total":
+        ("counter", "Conexiones aceptadas."),
+    "hftp_refused_connections_total":
+        ("counter", "Conexiones rechazadas con SERVER BUSY."),
+    "hftp_reaped_connections_total":
+        ("counter", "Conexiones cortadas por superar un limite de tiempo."),
+    "hftp_active_connections":
+        ("gauge", "Conexiones abiertas."),
+    "hftp_requests_total":
+        ("counter", "Comandos atendidos, por comando."),
+    "hftp_request_duration_seconds":
+        ("histogram", "Segundos por comando atendido, sin contar la "
+         "transferencia de los slices."),
+    "hftp_bytes_sent_total":
+        ("counter", "Bytes enviados a los clientes."),
+    "hftp_encode_seconds_total":
+        ("counter", "Segundos leyendo y codificando (o comprimiendo) "
+         "slices."),
+    "hftp_send_seconds_total":
+        ("counter", "Segundos en las llamadas al sistema que mandan datos."),
+    "hftp_cache_hits_total":
+        ("counter", "Aciertos de los caches del proceso, por cache."),
+    "hftp_cache_misses_total":
+        ("counter", "Fallos de los caches del proceso, por cache."),
+    "hftp_cache_entries":
+        ("gauge", "Entradas guardadas en los caches del proceso, por cache."),
+    "hftp_cache_bytes":
+        ("gauge", "Bytes guardados en el cache de bloques."),
+}
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # el último es +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics(object):
+    """
+    Registro de las métricas de un proceso. Cada métrica se identifica por
+    su nombre y una tupla de pares (etiqueta, valor). Las actualizaciones
+    sólo toman un lock y suman, así que se pueden hacer desde el camino
+    caliente de las conexiones y desde varios hilos.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}      # (nombre, etiquetas) -> número
+        self.histograms = {}  # (nombre, etiquetas) -> Histogram
+        self.collectors = []
+
+    def inc(self, name, amount=1, labels=()):
+        """
+        Suma amount a un contador (o a un valor, con amount negativo).
+        """
+        key = (name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def observe(self, name, value, labels=()):
+        """
+        Agrega una observación a un histograma.
+        """
+        key = (name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def add_collector(self, collector):
+        """
+        Agrega una función que se llama al armar las métricas y devuelve
+        ternas (nombre, etiquetas, valor): así se exportan contadores que
+        ya lleva otro objeto (p. ej. los aciertos de un cache) sin
+        actualizarlos dos veces.
+        """
+        with self.lock:
+            self.collectors.append(collector)
+
+    def remove_collector(self, collector):
+        with self.lock:
+            self.collectors.remove(collector)
+
+    def render(self):
+        """
+        Devuelve las métricas en el formato de texto de Prometheus, una
+        por línea (sin el terminador).
+        """
+        with self.lock:
+            values = dict(self.values)
+            collectors = list(self.collectors)
+            histograms = sorted((key, list(h.counts), h.sum, h.count)
+                                for key, h in self.histograms.items())
+        for collector in collectors:
+            for name, labels, value in collector():
+                values[(name, labels)] = value
+        values = sorted(values.items())
+        samples = {}
+        for (name, labels), value in values:
+            samples.setdefault(name, []).append(
+                "%s%s %s" % (name, _labels(labels), _number(value)))
+        for (name, labels), counts, total, count in histograms:
+            lines = samples.setdefault(name, [])
+            cumulative = 0
+            for bound, n in zip(LATENCY_BUCKETS + ("+Inf",), counts):
+                cumulative += n
+                lines.append("%s_bucket%s %d" % (
+                    name, _labels(labels + (("le", str(bound)),)),
+                    cumulative))
+            lines.append("%s_sum%s %s" % (name, _labels(labels),
+                                          _number(total)))
+            lines.append("%s_count%s %d" % (name, _labels(labels), count))
+        result = []
+        for name in sorted(samples):
+            kind, description = DESCRIPTIONS.get(name, ("untyped", name))
+            result.append("# HELP %s %s" % (name, description))
+            result.append("# TYPE %s %s" % (name, kind))
+            result.extend(samples[name])
+        return result
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % pair for pair in labels)
+
+
+def _number(value):
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+# Registro de este proceso, compartido por todas las conexiones.
+REGISTRY = Metrics()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = "".join(line + "\n" for line in REGISTRY.render())
+        body = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("metrics: " + format % args)
+
+
+def serve_http(addr, port):
+    """
+    Sirve las métricas de este proceso por HTTP (GET /metrics) desde un
+    hilo aparte. Devuelve el ThreadingHTTPServer.
+    """
+    httpd = ThreadingHTTPServer((addr, port), MetricsHandler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
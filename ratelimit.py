@@ -0,0 +1,42 @@
+# encoding: utf-8
+# Limitación del ancho de banda de los envíos con baldes de tokens.
+
+import threading
+import time
+from constants import *
+
+
+class TokenBucket(object):
+    """
+    Balde de tokens: deja enviar en promedio `rate' bytes por segundo, con
+    ráfagas de hasta `burst' bytes (por defecto, un segundo de envío).
+
+    Los bytes se cobran después de enviarse y el balde puede quedar en
+    deuda; quien envía debe esperar el tiempo que devuelve charge antes de
+    mandar la próxima parte. Así un mismo balde se puede compartir entre
+    varias conexiones (y varios hilos): cada una espera su turno según la
+    deuda acumulada por todas. Es seguro para usar desde varios hilos.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst if burst is not None else max(rate,
+                                                         SLICE_CHUNK_SIZE)
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def charge(self, amount):
+        """
+        Descuenta `amount' bytes ya enviados y devuelve cuántos segundos
+        hay que esperar antes de enviar más (0 si no hay deuda).
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
@@ -0,0 +1,78 @@
+# encoding: utf-8
+# Cierre de las conexiones que superaron sus límites de tiempo.
+
+import logging
+import threading
+import time
+import weakref
+from constants import *
+from metrics import REGISTRY as metrics
+
+
+class Reaper(object):
+    """
+    Hilo que revisa cada `interval' segundos las conexiones abiertas del
+    proceso y corta (con Connection.abort) las que:
+
+      - no tuvieron actividad (ni recibieron ni enviaron datos) en
+        idle_timeout segundos,
+      - empezaron una línea y no la completaron en read_timeout segundos,
+      - no terminaron de enviar la respuesta a un pedido en
+        request_timeout segundos.
+
+    Un límite en 0 no se controla. Las conexiones se guardan con
+    referencias débiles: las cerradas desaparecen solas.
+    """
+
+    def __init__(self, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT,
+                 request_timeout=DEFAULT_REQUEST_TIMEOUT,
+                 interval=REAPER_INTERVAL):
+        self.idle_timeout = idle_timeout
+        self.read_timeout = read_timeout
+        self.request_timeout = request_timeout
+        self.interval = interval
+        self.connections = weakref.WeakSet()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def add(self, conn):
+        """
+        Empieza a vigilar una conexión.
+        """
+        with self.lock:
+            self.connections.add(conn)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def sweep(self, now=None):
+        """
+        Corta las conexiones vencidas al instante now. Devuelve cuántas.
+        """
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            connections = list(self.connections)
+        reaped = 0
+        for conn in connections:
+            if not conn.connected and not conn.outgoing:
+                continue
+            reason = conn.expired(now, self.idle_timeout, self.read_timeout,
+                                  self.request_timeout)
+            if reason is not None:
+                logging.info(f"Cerrando una conexión vencida ({reason})")
+                with self.lock:
+                    self.connections.discard(conn)
+                conn.abort()
+                metrics.inc("hftp_reaped_connections_total",
+                            labels=(("reason", reason),))
+                reaped += 1
+        return reaped
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.sweep()
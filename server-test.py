@@ -6,9 +6,17 @@
 # $Id: server-test.py 388 2011-03-22 14:20:06Z nicolasw $
 
 import unittest
+import unittest.mock
+import asyncio
+import errno
+import hashlib
+import async_client
 import client
 import constants
+import dirindex
 import select
+import server
+import threading
 import time
 import socket
 import os
@@ -48,6 +56,25 @@ class TestBase(unittest.TestCase):
             del self.output_file
 
     # Funciones auxiliares:
+    def start_server(self, **options):
+        """
+        Lanza en un hilo un server propio, con las opciones dadas, sobre
+        DATADIR y en un puerto libre. Se detiene al terminar el test.
+        Devuelve el puerto.
+        """
+        srv = server.Server('localhost', 0, DATADIR, **options)
+        thread = threading.Thread(target=srv.serve, daemon=True)
+        thread.start()
+        while not srv.sock.getsockopt(socket.SOL_SOCKET,
+                                      socket.SO_ACCEPTCONN):
+            time.sleep(0.01)
+
+        def stop():
+            srv.stop()
+            thread.join(constants.SHUTDOWN_TIMEOUT + TIMEOUT)
+        self.addCleanup(stop)
+        return srv.sock.getsockname()[1]
+
     def new_client(self):
         assert not hasattr(self, 'client')
         try:
@@ -122,6 +149,48 @@ class TestHFTPServer(TestBase):
                          "El tamaño reportado para el archivo no es el correcto")
         c.close()
 
+    def test_get_metadata_after_change(self):
+        f = open(os.path.join(DATADIR, 'bar'), 'w')
+        f.write('x' * 10)
+        f.close()
+        c = self.new_client()
+        self.assertEqual(c.get_metadata('bar'), 10)
+        f = open(os.path.join(DATADIR, 'bar'), 'a')
+        f.write('y' * 5)
+        f.close()
+        open(os.path.join(DATADIR, 'foo'), 'w').close()
+        self.assertEqual(c.get_metadata('bar'), 15,
+                         "El tamaño reportado no refleja el cambio del archivo")
+        self.assertEqual(sorted(c.file_lookup()), ['bar', 'foo'],
+                         "El listado no refleja el archivo nuevo")
+        c.close()
+
+    def test_index_lookups_from_memory(self):
+        path = os.path.join(DATADIR, 'bar')
+        with open(path, 'w') as f:
+            f.write('x' * 10)
+        index = dirindex.DirectoryIndex(DATADIR)
+        self.addCleanup(index.close)
+        if index.watcher is None:
+            self.skipTest("Sin inotify")
+        self.assertEqual(index.size('bar'), 10)
+        # Sin cambios, las consultas no hacen stat
+        with unittest.mock.patch('os.stat', side_effect=AssertionError(
+                "stat en una consulta sin cambios")):
+            for _ in range(1000):
+                self.assertEqual(index.size('bar'), 10)
+        # Los cambios se ven en la consulta siguiente, también si el
+        # directorio se reemplaza mientras hay un archivo suyo abierto
+        with open(path, 'a') as f:
+            f.write('y' * 5)
+        self.assertEqual(index.size('bar'), 15)
+        with open(path, 'rb'):
+            os.system('rm -rf %s' % DATADIR)
+            os.mkdir(DATADIR)
+            open(os.path.join(DATADIR, 'foo'), 'w').close()
+            self.assertEqual(index.size('bar'), None)
+            self.assertEqual(index.size('foo'), 0)
+
     def test_get_full_slice(self):
         self.output_file = 'bar'
         test_data = 'The quick brown fox jumped over the lazy dog'
@@ -171,6 +240,336 @@ class TestHFTPServer(TestBase):
         f.close()
         c.close()
 
+    def test_binary_slice(self):
+        self.output_file = 'bar'
+        test_data = bytes(range(256)) * 4 + b'\r\n\r\n'
+        f = open(os.path.join(DATADIR, self.output_file), 'wb')
+        f.write(test_data)
+        f.close()
+        c = self.new_client()
+        self.assertTrue(c.set_mode('binary'))
+        self.assertEqual(c.status, constants.CODE_OK)
+        c.get_slice(self.output_file, 10, len(test_data) - 10)
+        self.assertEqual(c.status, constants.CODE_OK)
+        f = open(self.output_file, 'rb')
+        self.assertEqual(f.read(), test_data[10:],
+                         "El contenido del slice binario no es el correcto")
+        f.close()
+        c.close()
+
+    def test_slice_after_rewrite(self):
+        self.output_file = 'bar'
+        path = os.path.join(DATADIR, self.output_file)
+        c = self.new_client()
+        for mode in ('base64', 'binary'):
+            self.assertTrue(c.set_mode(mode))
+            for test_data in (b'x' * 1000, b'y' * 1500):
+                with open(path, 'wb') as f:
+                    f.write(test_data)
+                fragment = c.read_slice(self.output_file, 1, 900)
+                self.assertEqual(c.status, constants.CODE_OK)
+                self.assertEqual(fragment, test_data[1:901],
+                                 "El slice no refleja el archivo reescrito")
+        c.close()
+
+    def test_slice_after_truncate(self):
+        # Achicar el archivo mientras hay slices suyos encolados corta esas
+        # respuestas, pero no debe tirar abajo al server.
+        self.output_file = 'bar'
+        path = os.path.join(DATADIR, self.output_file)
+        size = 2**20
+        for mode in ('base64', 'binary'):
+            with open(path, 'wb') as f:
+                f.write(os.urandom(size))
+            c = client.Client()
+            c.s.sendall(('set_mode %s\r\n' % mode +
+                         'get_slice %s 0 %d\r\n' % (self.output_file, size)
+                         * 20).encode("ascii"))
+            time.sleep(0.2)
+            os.truncate(path, 0)
+            c.s.settimeout(1)
+            try:
+                while c.s.recv(constants.RECV_SIZE):
+                    pass
+            except socket.timeout:
+                pass
+            c.s.close()
+            d = client.Client()
+            d.get_metadata(self.output_file)
+            self.assertEqual(d.status, constants.CODE_OK,
+                             "El server no responde tras achicar el archivo")
+            d.close()
+
+    def test_unreadable_slice(self):
+        # Si el archivo no se puede abrir, la respuesta es sólo el error y
+        # la conexión sigue sincronizada
+        with open(os.path.join(DATADIR, 'locked'), 'wb') as f:
+            f.write(b'x' * 1000)
+        real_open = os.open
+
+        def locked_open(path, *args, **kwargs):
+            if os.path.basename(path) == 'locked':
+                raise PermissionError(errno.EACCES, "Permission denied", path)
+            return real_open(path, *args, **kwargs)
+        servers = [{'engine': engine} for engine in constants.ENGINES] + \
+            [{'open_files': 0}, {'open_files': 0, 'cache_size': 0}]
+        for options in servers:
+            port = self.start_server(**options)
+            c = client.Client('localhost', port)
+            for mode in ('binary', 'zlib', 'base64'):
+                self.assertTrue(c.set_mode(mode))
+                with unittest.mock.patch('os.open', locked_open):
+                    c.send('get_slice locked 0 6')
+                    status, message = c.read_response_line(TIMEOUT)
+                self.assertEqual(status, constants.INTERNAL_ERROR,
+                                 "%s/%s: se esperaba sólo el error" %
+                                 (options, mode))
+                self.assertEqual(c.get_metadata('locked'), 1000,
+                                 "%s/%s: la conexión quedó desincronizada" %
+                                 (options, mode))
+                with unittest.mock.patch('os.open', locked_open):
+                    c.send('get_slices locked 0 6 10 20')
+                    status, message = c.read_response_line(TIMEOUT)
+                self.assertEqual(status, constants.INTERNAL_ERROR,
+                                 "%s/%s: get_slices no devolvió sólo el "
+                                 "error" % (options, mode))
+                self.assertEqual(c.get_metadata('locked'), 1000,
+                                 "%s/%s: get_slices desincronizó la "
+                                 "conexión" % (options, mode))
+            c.close()
+
+    def test_slices_reuse_open_files(self):
+        # Con el cache de archivos abiertos, ningún modo ni get_slices
+        # vuelve a abrir un archivo que no cambió
+        test_data = os.urandom(100000)
+        with open(os.path.join(DATADIR, 'bar'), 'wb') as f:
+            f.write(test_data)
+        port = self.start_server()
+        c = client.Client('localhost', port)
+        self.assertEqual(c.read_slice('bar', 0, 10), test_data[:10])
+        real_open = os.open
+        opens = []
+
+        def counting_open(path, *args, **kwargs):
+            if os.path.basename(path) == 'bar':
+                opens.append(path)
+            return real_open(path, *args, **kwargs)
+        with unittest.mock.patch('os.open', counting_open):
+            for mode in ('base64', 'binary', 'zlib'):
+                self.assertTrue(c.set_mode(mode))
+                self.assertEqual(c.read_slice('bar', 1000, 5000),
+                                 test_data[1000:6000])
+                self.assertEqual(c.get_slices('bar', [(7, 3), (90000, 10)]),
+                                 [test_data[7:10], test_data[90000:90010]])
+        self.assertEqual(opens, [], "Se reabrió el archivo en cada pedido")
+        c.close()
+
+    def test_get_slices(self):
+        self.output_file = 'bar'
+        test_data = os.urandom(200000)
+        with open(os.path.join(DATADIR, self.output_file), 'wb') as f:
+            f.write(test_data)
+        # Desordenados, superpuestos, contiguos, vacíos y hasta el final
+        ranges = [(150000, 50000), (10, 100), (50, 100), (110, 7), (0, 0),
+                  (300, 1), (199999, 1), (117, 0)]
+        c = self.new_client()
+        for mode in ('base64', 'binary', 'zlib'):
+            self.assertTrue(c.set_mode(mode))
+            fragments = c.get_slices(self.output_file, ranges)
+            self.assertEqual(c.status, constants.CODE_OK)
+            self.assertEqual(fragments,
+                             [test_data[o:o + n] for o, n in ranges],
+                             "Los fragmentos en modo %s no son los correctos"
+                             % mode)
+        c.get_slices(self.output_file, [(0, 10), (199999, 2)])
+        self.assertEqual(c.status, constants.BAD_OFFSET)
+        c.send('get_slices %s 0 10 20' % self.output_file)
+        self.assertEqual(c.read_response_line()[0],
+                         constants.INVALID_ARGUMENTS)
+        c.get_slices('nonexistent', [(0, 1)])
+        self.assertEqual(c.status, constants.FILE_NOT_FOUND)
+        c.close()
+
+    def test_segmented_retrieve(self):
+        self.output_file = 'big'
+        # Varios pedazos de DOWNLOAD_CHUNK_SIZE, el último incompleto
+        test_data = os.urandom(2 * constants.DOWNLOAD_CHUNK_SIZE + 12345)
+        with open(os.path.join(DATADIR, self.output_file), 'wb') as f:
+            f.write(test_data)
+        c = self.new_client()
+        # Sin resume no se pide la suma del archivo
+        c.get_checksum = unittest.mock.Mock(side_effect=AssertionError(
+            "Se pidió la suma en una descarga sin resume"))
+        for mode in ('base64', 'binary', 'zlib'):
+            self.assertTrue(c.set_mode(mode))
+            c.retrieve(self.output_file, jobs=3)
+            self.assertEqual(c.status, constants.CODE_OK)
+            with open(self.output_file, 'rb') as f:
+                self.assertEqual(f.read(), test_data,
+                                 "El archivo bajado en paralelo en modo %s "
+                                 "no es el correcto" % mode)
+            os.remove(self.output_file)
+            self.assertFalse(os.path.exists(
+                self.output_file + constants.JOURNAL_SUFFIX))
+        c.close()
+
+    def test_resume_retrieve(self):
+        self.output_file = 'big'
+        path = os.path.join(DATADIR, self.output_file)
+        journal = self.output_file + constants.JOURNAL_SUFFIX
+        chunk = 2**16
+        test_data = os.urandom(10 * chunk + 123)
+        with open(path, 'wb') as f:
+            f.write(test_data)
+        c = self.new_client()
+        fetch_slice = c.fetch_slice
+        fetched = []
+        cut_after = [None]  # pedazos tras los que se corta la conexión
+
+        def counted(filename, start, length, write):
+            if len(fetched) == cut_after[0]:
+                raise socket.error("Conexión cortada")
+            fetched.append(start)
+            return fetch_slice(filename, start, length, write)
+
+        def retrieve(cut=None, resume=True):
+            fetched.clear()
+            cut_after[0] = cut
+            c.retrieve_chunked(self.output_file, len(test_data),
+                               resume=resume, chunk_size=chunk)
+
+        c.fetch_slice = counted
+        # La descarga se corta después de tres pedazos y se retoma
+        retrieve(cut=3)
+        self.assertNotEqual(c.status, constants.CODE_OK)
+        self.assertTrue(os.path.exists(journal))
+        retrieve()
+        self.assertEqual(c.status, constants.CODE_OK)
+        self.assertEqual(len(fetched), 8, "Al retomar se volvieron a pedir "
+                         "pedazos ya bajados")
+        with open(self.output_file, 'rb') as f:
+            self.assertEqual(f.read(), test_data)
+        self.assertFalse(os.path.exists(journal))
+        # Sin la salida, o si el archivo del server cambió aunque conserve
+        # el tamaño, el registro se ignora y se baja todo de nuevo
+        for case in ('missing output', 'changed file'):
+            retrieve(cut=3)
+            if case == 'missing output':
+                os.remove(self.output_file)
+            else:
+                test_data = os.urandom(len(test_data))
+                with open(path, 'wb') as f:
+                    f.write(test_data)
+            retrieve()
+            self.assertEqual(c.status, constants.CODE_OK)
+            self.assertEqual(len(fetched), 11)
+            with open(self.output_file, 'rb') as f:
+                self.assertEqual(f.read(), test_data,
+                                 "Se retomó una descarga inválida (%s)"
+                                 % case)
+        # Una descarga sin resume no pide la suma, baja todo y descarta el
+        # registro de un intento anterior
+        retrieve(cut=3)
+        self.assertTrue(os.path.exists(journal))
+        get_checksum = c.get_checksum
+        c.get_checksum = unittest.mock.Mock(wraps=get_checksum)
+        retrieve(resume=False)
+        self.assertEqual(c.status, constants.CODE_OK)
+        self.assertFalse(c.get_checksum.called)
+        self.assertEqual(len(fetched), 11)
+        self.assertFalse(os.path.exists(journal))
+        with open(self.output_file, 'rb') as f:
+            self.assertEqual(f.read(), test_data)
+        c.close()
+
+    def test_zlib_slice(self):
+        self.output_file = 'bar'
+        test_data = b''.join(b'linea %d del log\r\n' % i
+                             for i in range(20000))
+        f = open(os.path.join(DATADIR, self.output_file), 'wb')
+        f.write(test_data)
+        f.close()
+        c = self.new_client()
+        self.assertTrue(c.set_mode('zlib'))
+        for _ in range(2):  # La segunda vez puede venir del cache
+            fragment = c.read_slice(self.output_file, 7, len(test_data) - 9)
+            self.assertEqual(c.status, constants.CODE_OK)
+            self.assertEqual(fragment, test_data[7:-2],
+                             "El contenido del slice comprimido no es el "
+                             "correcto")
+        self.assertEqual(c.read_slice(self.output_file, 5, 0), b'')
+        c.close()
+
+    def test_metadata_many(self):
+        for name, size in (('a', 10), ('bb', 0), ('ccc', 1234)):
+            with open(os.path.join(DATADIR, name), 'wb') as f:
+                f.write(b'x' * size)
+        os.mkdir(os.path.join(DATADIR, 'subdir'))
+        c = self.new_client()
+        sizes = c.get_metadata_many(['ccc', 'nonexistent', 'a'])
+        self.assertEqual(c.status, constants.CODE_OK)
+        self.assertEqual(sizes, {'ccc': 1234, 'a': 10})
+        sizes = c.file_lookup_with_sizes()
+        self.assertEqual(c.status, constants.CODE_OK)
+        self.assertEqual(sizes, {'a': 10, 'bb': 0, 'ccc': 1234},
+                         "El listado con tamaños no es el correcto")
+        c.close()
+
+    def test_checksum(self):
+        self.output_file = 'big'
+        # Más grande que CHECKSUM_INLINE_MAX: se calcula en el pool
+        test_data = os.urandom(3 * 2**20 + 5)
+        with open(os.path.join(DATADIR, self.output_file), 'wb') as f:
+            f.write(test_data)
+        with open(os.path.join(DATADIR, 'small'), 'wb') as f:
+            f.write(b'hola')
+        c = self.new_client()
+        self.assertEqual(c.get_checksum(self.output_file),
+                         ('sha256', hashlib.sha256(test_data).hexdigest()))
+        self.assertEqual(c.get_checksum(self.output_file, 10, 2**20),
+                         ('sha256', hashlib.sha256(
+                             test_data[10:10 + 2**20]).hexdigest()))
+        # La respuesta calculada aparte no se adelanta ni se atrasa
+        c.send('get_checksum %s 1 %d\r\nget_metadata small'
+               % (self.output_file, len(test_data) - 1))
+        self.assertEqual(c.read_response_line(TIMEOUT)[0], constants.CODE_OK)
+        self.assertEqual(c.read_line(TIMEOUT), 'sha256 %s' % hashlib.sha256(
+            test_data[1:]).hexdigest())
+        self.assertEqual(c.read_response_line(TIMEOUT)[0], constants.CODE_OK)
+        self.assertEqual(c.read_line(TIMEOUT), '4')
+        c.get_checksum(self.output_file, 1, len(test_data))
+        self.assertEqual(c.status, constants.BAD_OFFSET)
+        c.send('get_checksum %s 1' % self.output_file)
+        self.assertEqual(c.read_response_line(TIMEOUT)[0],
+                         constants.INVALID_ARGUMENTS)
+        # Con una copia local igual no se vuelve a bajar
+        with open(self.output_file, 'wb') as f:
+            f.write(test_data)
+        mtime = os.stat(self.output_file).st_mtime_ns
+        c.retrieve(self.output_file, skip_unchanged=True)
+        self.assertEqual(os.stat(self.output_file).st_mtime_ns, mtime)
+        with open(self.output_file, 'r+b') as f:
+            f.write(b'X')
+        c.retrieve(self.output_file, skip_unchanged=True)
+        with open(self.output_file, 'rb') as f:
+            self.assertEqual(f.read(), test_data)
+        c.close()
+
+    def test_stats(self):
+        c = self.new_client()
+        c.get_metadata('nonexistent')
+        stats = c.get_stats()
+        self.assertEqual(c.status, constants.CODE_OK)
+        self.assertIn('# TYPE hftp_requests_total counter', stats)
+        counted = [line for line in stats if line.startswith(
+            'hftp_requests_total{command="get_metadata"} ')]
+        self.assertEqual(len(counted), 1)
+        self.assertGreaterEqual(int(counted[0].split()[1]), 1)
+        self.assertTrue(any(line.startswith(
+            'hftp_cache_misses_total{cache="checksums"} ') for line in stats),
+            "Las métricas no incluyen los contadores de los caches")
+        c.close()
+
 
 class TestHFTPErrors(TestBase):
 
@@ -219,6 +618,24 @@ class TestHFTPErrors(TestBase):
                          "mal tipada (status=%d)" % status)
         c.close()
 
+    def test_slice_file_not_found(self):
+        c = self.new_client()
+        c.send('get_slice does_not_exist 0 1')
+        status, message = c.read_response_line(TIMEOUT)
+        self.assertEqual(status, constants.FILE_NOT_FOUND,
+                         "El servidor no contestó 202 ante un slice de un "
+                         "archivo inexistente")
+        c.close()
+
+    def test_bad_mode(self):
+        c = self.new_client()
+        c.send('set_mode ebcdic')
+        status, message = c.read_response_line(TIMEOUT)
+        self.assertEqual(status, constants.INVALID_ARGUMENTS,
+                         "El servidor no contestó 201 ante un modo de "
+                         "transferencia inválido")
+        c.close()
+
     def test_file_not_found(self):
         c = self.new_client()
         c.send('get_metadata does_not_exist')
@@ -263,6 +680,71 @@ class TestHFTPHard(TestBase):
                          "nombre muy largo (status=%d)" % status)
         c.close()
 
+    def test_line_too_long(self):
+        c = self.new_client()
+        c.s.sendall(b'x' * (constants.DEFAULT_MAX_LINE + 1))
+        status, message = c.read_response_line(TIMEOUT * 6)
+        self.assertEqual(status, constants.BAD_REQUEST,
+                         "El servidor no contestó 101 ante una línea más "
+                         "larga que el máximo (status=%s)" % status)
+        c.read_line(TIMEOUT)
+        self.assertFalse(c.connected, "El server no cerró la conexión")
+
+    def test_server_busy(self):
+        for engine in constants.ENGINES:
+            port = self.start_server(engine=engine, max_connections=2)
+            admitted = [client.Client('localhost', port) for _ in range(2)]
+            c = client.Client('localhost', port)
+            status, message = c.read_response_line(TIMEOUT)
+            self.assertEqual(status, constants.SERVER_BUSY,
+                             "El servidor %s no contestó 102 estando "
+                             "saturado (status=%s)" % (engine, status))
+            c.read_line(TIMEOUT)
+            self.assertFalse(c.connected, "El server no cerró la conexión "
+                             "rechazada")
+            c.s.close()
+            for a in admitted:
+                self.assertEqual(a.get_metadata('nonexistent'), None)
+                self.assertEqual(a.status, constants.FILE_NOT_FOUND)
+                a.close()
+
+    def test_idle_connections_not_queued(self):
+        # Las conexiones que esperan un comando no ocupan lugar en la cola
+        # de espera de los hilos
+        for engine in constants.ENGINES:
+            port = self.start_server(engine=engine, max_workers=1,
+                                     max_queued=1)
+            idle = []
+            for _ in range(10):
+                c = client.Client('localhost', port)
+                self.assertEqual(c.get_metadata('nonexistent'), None)
+                self.assertEqual(c.status, constants.FILE_NOT_FOUND,
+                                 "El servidor %s rechazó una conexión con "
+                                 "las demás ociosas" % engine)
+                idle.append(c)
+            for c in idle:
+                c.close()
+
+    def test_stalled_transfers_release_workers(self):
+        # Un archivo disperso más grande que los buffers de los sockets
+        with open(os.path.join(DATADIR, 'big'), 'wb') as f:
+            f.truncate(64 * 2**20)
+        # Un cliente que no lee lo que pidió y uno limitado en ancho de
+        # banda no deben retener el único hilo del server
+        for options in ({}, {'rate_limit': 16 * 2**10}):
+            port = self.start_server(max_workers=1, **options)
+            stalled = socket.create_connection(('localhost', port))
+            stalled.sendall(b'set_mode binary\r\nget_slice big 0 %d\r\n'
+                            % (64 * 2**20))
+            time.sleep(0.5)
+            c = client.Client('localhost', port)
+            c.send('get_metadata big')
+            status, message = c.read_response_line(TIMEOUT)
+            self.assertEqual(status, constants.CODE_OK)
+            self.assertEqual(c.read_line(TIMEOUT), str(64 * 2**20))
+            c.close()
+            stalled.close()
+
     def test_data_with_nulls(self):
         self.output_file = 'bar'
         test_data = 'x' * 100 + '\0' * 100 + 'y' * 100
@@ -292,6 +774,84 @@ class TestHFTPHard(TestBase):
                          "La lista de 1000 archivos no es la correcta")
         c.close()
 
+    def test_async_pool(self):
+        self.output_file = 'pooled'
+        test_data = os.urandom(3000)
+        with open(os.path.join(DATADIR, 'pooled'), 'wb') as f:
+            f.write(test_data)
+
+        async def run():
+            async with async_client.ClientPool('localhost', max_size=2,
+                                               mode='binary') as pool:
+                slices = await asyncio.wait_for(asyncio.gather(
+                    *(pool.read_slice('pooled', i * 500, 500)
+                      for i in range(6))), TIMEOUT)
+                missing = await pool.get_metadata('nonexistent')
+                saved = await pool.get_slice('pooled', 100, 200)
+                with open('pooled', 'rb') as f:
+                    saved = saved, f.read()
+                return slices, missing, saved, len(pool.idle)
+
+        async def retrieve():
+            c = await async_client.AsyncClient.connect('localhost')
+            try:
+                self.assertTrue(await c.set_mode('zlib'))
+                self.assertTrue(await c.ping())
+                return await c.retrieve('pooled')
+            finally:
+                await c.close()
+
+        slices, missing, saved, idle = asyncio.run(run())
+        self.assertEqual(b''.join(slices), test_data,
+                         "Los slices pedidos por el pool no son correctos")
+        self.assertIsNone(missing)
+        self.assertEqual(saved, (200, test_data[100:300]),
+                         "El slice guardado por el pool no es correcto")
+        self.assertLessEqual(idle, 2, "El pool abrió más conexiones de "
+                             "las permitidas")
+        self.assertEqual(asyncio.run(retrieve()), len(test_data))
+        with open('pooled', 'rb') as f:
+            self.assertEqual(f.read(), test_data,
+                             "El archivo bajado con AsyncClient no es el "
+                             "correcto")
+
+
+    def test_async_pool_expiry(self):
+        with open(os.path.join(DATADIR, 'bar'), 'wb') as f:
+            f.write(b'x' * 10)
+
+        async def expire(port):
+            # Las conexiones libres se cierran solas, sin volver a usar el
+            # pool
+            async with async_client.ClientPool(
+                    'localhost', port, idle_timeout=0.2) as pool:
+                self.assertEqual(await pool.get_metadata('bar'), 10)
+                (_, pooled), = pool.idle
+                await asyncio.sleep(0.5)
+                return pool.idle, pooled.connected
+
+        async def reconnect(port):
+            # Una conexión que el server cortó no pasa el ping y se
+            # reemplaza por una nueva
+            async with async_client.ClientPool(
+                    'localhost', port, check_after=0.1) as pool:
+                self.assertEqual(await pool.get_metadata('bar'), 10)
+                (_, pooled), = pool.idle
+                await asyncio.sleep(constants.REAPER_INTERVAL + 1)
+                size = await asyncio.wait_for(pool.get_metadata('bar'),
+                                              TIMEOUT)
+                (_, fresh), = pool.idle
+                return size, pooled.connected, fresh is pooled
+
+        idle, connected = asyncio.run(expire(self.start_server()))
+        self.assertEqual(idle, [], "El pool conservó conexiones vencidas")
+        self.assertFalse(connected, "No se cerró la conexión vencida")
+        size, connected, reused = asyncio.run(
+            reconnect(self.start_server(idle_timeout=0.2)))
+        self.assertEqual(size, 10)
+        self.assertFalse(connected, "No se descartó la conexión cortada")
+        self.assertFalse(reused, "Se reusó la conexión cortada")
+
 
 def suite():
     suite = unittest.TestSuite()
@@ -6,14 +6,98 @@
 # Copyright 2008-2010 Natalia Bidart y Daniel Moisset
 # $Id: server.py 656 2013-03-18 23:49:11Z bc $
 
+import blockcache
+import checksum
 import connection
+import dirindex
+import filecache
+import heapq
+import logging
+import metrics
 import optparse
 import os
+import queue
+import ratelimit
+import reaper
+import selectors
+import signal
 import socket
 import sys
+import time
 from constants import *
 import threading
 
+
+class ConnectionParking(object):
+    """
+    Conexiones del motor de hilos que esperan algo para seguir sin ocupar
+    un hilo: un comando del cliente, que el socket acepte más datos o que
+    venza la espera de su límite de ancho de banda. Un hilo propio las
+    vigila con un selector y, cuando pueden seguir, las devuelve a la cola
+    de conexiones pendientes.
+    """
+
+    def __init__(self, pending):
+        self.pending = pending
+        self.sel = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.arriving = []  # (conexión, eventos, instante) por registrar
+        self.delayed = []  # heap de (instante, id, conexión)
+        # El hilo despierta del select cuando le escriben a este pipe.
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_r, False)
+        self.sel.register(self.wakeup_r, selectors.EVENT_READ, None)
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def park(self, conn, events=selectors.EVENT_READ):
+        """
+        Deja la conexión esperando que su socket esté listo para events:
+        por defecto, datos del cliente.
+        """
+        self._arrive(conn, events, None)
+
+    def delay(self, conn, when):
+        """
+        Deja la conexión esperando hasta el instante when (de
+        time.monotonic).
+        """
+        self._arrive(conn, None, when)
+
+    def _arrive(self, conn, events, when):
+        with self.lock:
+            self.arriving.append((conn, events, when))
+        os.write(self.wakeup_w, b"\0")
+
+    def _run(self):
+        while True:
+            timeout = None
+            if self.delayed:
+                timeout = max(self.delayed[0][0] - time.monotonic(), 0)
+            for key, mask in self.sel.select(timeout):
+                if key.data is None:
+                    self._register_arriving()
+                else:
+                    self.sel.unregister(key.fileobj)
+                    self.pending.put(key.data)
+            now = time.monotonic()
+            while self.delayed and self.delayed[0][0] <= now:
+                self.pending.put(heapq.heappop(self.delayed)[2])
+
+    def _register_arriving(self):
+        try:
+            while os.read(self.wakeup_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        with self.lock:
+            arriving, self.arriving = self.arriving, []
+        for conn, events, when in arriving:
+            if when is not None:
+                heapq.heappush(self.delayed, (when, id(conn), conn))
+            else:
+                self.sel.register(conn.socket, events, conn)
+
+
 class Server(object):
     """
     El servidor, que crea y atiende el socket en la dirección y puerto
@@ -21,7 +105,22 @@ class Server(object):
     """
 
     def __init__(self, addr=DEFAULT_ADDR, port=DEFAULT_PORT,
-                 directory=DEFAULT_DIR):
+                 directory=DEFAULT_DIR, engine=DEFAULT_ENGINE,
+                 max_workers=DEFAULT_MAX_WORKERS,
+                 max_queued=DEFAULT_MAX_QUEUED,
+                 listen_backlog=DEFAULT_LISTEN_BACKLOG, processes=1,
+                 cache_size=DEFAULT_CACHE_SIZE,
+                 compress_level=DEFAULT_COMPRESS_LEVEL,
+                 rate_limit=DEFAULT_RATE_LIMIT,
+                 global_rate_limit=DEFAULT_GLOBAL_RATE_LIMIT,
+                 quantum=DEFAULT_QUANTUM, metrics_port=None,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT,
+                 request_timeout=DEFAULT_REQUEST_TIMEOUT,
+                 max_line=DEFAULT_MAX_LINE,
+                 open_files=DEFAULT_OPEN_FILES,
+                 checksum_workers=DEFAULT_CHECKSUM_WORKERS,
+                 max_connections=DEFAULT_MAX_CONNECTIONS):
         """
         Inicializa el servidor con la dirección, puerto y directorio
         especificados.
@@ -30,28 +129,512 @@ class Server(object):
           - addr: dirección donde escuchar por conexiones entrantes.
           - port: puerto donde escuchar por conexiones entrantes.
           - directory: directorio donde guardar los archivos recibidos.   
+          - engine: "threads" (un hilo por conexión) o "async" (todas las
+            conexiones multiplexadas en un único event loop).
+          - max_workers: cantidad de hilos que atienden conexiones.
+          - max_queued: en el motor de hilos, conexiones con trabajo listo
+            que pueden esperar un hilo libre. Si hay más de max_workers +
+            max_queued ocupando o esperando un hilo, las conexiones nuevas
+            se rechazan con SERVER_BUSY; las que esperan un comando o al
+            cliente no cuentan.
+          - listen_backlog: cola de conexiones pendientes en el kernel.
+          - processes: cantidad de procesos que atienden el mismo socket.
+            Con más de uno, este proceso queda como supervisor.
+          - cache_size: bytes del cache de bloques de cada proceso (0 lo
+            desactiva).
+          - compress_level: nivel de zlib de los slices en modo "zlib".
+          - rate_limit: bytes por segundo de slices que puede recibir cada
+            conexión (0: sin límite).
+          - global_rate_limit: bytes por segundo de slices entre todas las
+            conexiones de cada proceso (0: sin límite).
+          - quantum: bytes de slices que envía cada conexión por turno antes
+            de ceder el lugar a las demás (0: sin turnos). En el motor de
+            hilos, una conexión que agota su turno vuelve a la cola de
+            espera, así una transferencia grande no retiene un hilo
+            mientras otros clientes esperan.
+          - metrics_port: si se da, cada proceso sirve sus métricas por
+            HTTP en addr, en este puerto (con varios procesos, el hijo
+            i-ésimo usa metrics_port + i).
+          - idle_timeout, read_timeout, request_timeout: segundos tras los
+            que se corta una conexión sin actividad, con una línea a medio
+            recibir o con la respuesta a un pedido a medio enviar (0: sin
+            límite; ver reaper.Reaper).
+          - max_line: largo máximo en bytes de una línea de pedido; una más
+            larga se responde con BAD_REQUEST.
+          - open_files: archivos que cada proceso mantiene abiertos para
+            leer los slices (0 lo desactiva).
+          - checksum_workers: hilos de cada proceso que calculan las sumas
+            de verificación de los archivos grandes.
+          - max_connections: conexiones abiertas a la vez en cada proceso,
+            con cualquier motor; las que siguen se rechazan con
+            SERVER_BUSY (0: sin límite).
         """
+        if engine not in ENGINES:
+            raise ValueError(f"Motor de servidor desconocido: {engine}")
         print("Serving %s on %s:%s." % (directory, addr, port))
         if not os.path.isdir(directory):
             os.mkdir(directory)
 
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.sock.bind((addr, port))
         self.directory = directory
+        self.engine = engine
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.max_connections = max_connections
+        self.listen_backlog = listen_backlog
+        self.processes = processes
+        self.cache_size = cache_size
+        self.compress_level = compress_level
+        self.rate_limit = rate_limit
+        self.global_rate_limit = global_rate_limit
+        self.quantum = quantum or None
+        self.metrics_port = metrics_port
+        self.timeouts = (idle_timeout, read_timeout, request_timeout)
+        self.max_line = max_line
+        self.open_files = open_files
+        self.checksum_workers = checksum_workers
+        self.stopping = False
+        self.active = 0
+        self.busy = 0  # conexiones que atiende un hilo (motor de hilos)
 
     def serve(self):
         """
-        Pone a escuchar al servidor por conexiones entrantes y lanza un hilo
-        para atender a cada una de ellas.
+        Pone a escuchar al servidor por conexiones entrantes y las atiende
+        con el motor elegido, en este proceso o en varios procesos hijos.
         """
-        self.sock.listen()
-        while True:
-            (clientsocket, address) = self.sock.accept()
-            conn = connection.Connection(clientsocket, self.directory)
-            print(f"Conectado por: {address}")
-            # Se crea un hilo para atender la conexión
-            t = threading.Thread(target=conn.handle)
+        self.sock.listen(self.listen_backlog)
+        if self.processes > 1:
+            self.supervise()
+            return
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self._on_signal)
+        self._serve_engine(self.metrics_port)
+
+    def _serve_engine(self, metrics_port=None):
+        """
+        Atiende conexiones con el motor configurado hasta que se pida
+        detener el servidor. Si se da metrics_port, mientras tanto sirve
+        las métricas del proceso por HTTP en ese puerto.
+        """
+        httpd = None
+        if metrics_port is not None:
+            httpd = metrics.serve_http(self.sock.getsockname()[0],
+                                       metrics_port)
+        # Cada proceso arma su propio índice del directorio (el de inotify
+        # no se puede compartir entre procesos).
+        self.index = dirindex.shared_index(self.directory)
+        self.cache = blockcache.BlockCache(self.cache_size) \
+            if self.cache_size > 0 else None
+        self.files = filecache.OpenFiles(self.open_files) \
+            if self.open_files > 0 else None
+        self.checksums = checksum.Checksums(self.checksum_workers)
+        self.global_bucket = ratelimit.TokenBucket(self.global_rate_limit) \
+            if self.global_rate_limit > 0 else None
+        self.reaper = reaper.Reaper(*self.timeouts) if any(self.timeouts) \
+            else None
+        metrics.REGISTRY.add_collector(self._cache_samples)
+        if self.engine == "async":
+            self.serve_async()
+        else:
+            self.serve_threads()
+        metrics.REGISTRY.remove_collector(self._cache_samples)
+        self.sock.close()
+        if self.reaper is not None:
+            self.reaper.stop()
+        if httpd is not None:
+            httpd.shutdown()
+            httpd.server_close()
+        if self.cache is not None:
+            print(f"Cache de bloques: {self.cache.stats()}")
+        if self.files is not None:
+            print(f"Archivos abiertos: {self.files.stats()}")
+        self.checksums.close()
+        print(f"Sumas de verificación: {self.checksums.stats()}")
+
+    def _cache_samples(self):
+        """
+        Devuelve, para las métricas, los contadores de los caches del
+        proceso: el de bloques, el de archivos abiertos y el de sumas de
+        verificación.
+        """
+        caches = [("checksums", self.checksums.stats())]
+        if self.cache is not None:
+            caches.append(("blocks", self.cache.stats()))
+        if self.files is not None:
+            caches.append(("open_files", self.files.stats()))
+        samples = []
+        for name, stats in caches:
+            labels = (("cache", name),)
+            samples.append(("hftp_cache_hits_total", labels, stats["hits"]))
+            samples.append(("hftp_cache_misses_total", labels,
+                            stats["misses"]))
+            samples.append(("hftp_cache_entries", labels, stats["entries"]))
+            if "bytes" in stats:
+                samples.append(("hftp_cache_bytes", labels, stats["bytes"]))
+        return samples
+
+    def _limiters(self):
+        """
+        Devuelve los baldes que limitan una conexión nueva: uno propio y el
+        global del proceso, según estén configurados.
+        """
+        limiters = []
+        if self.rate_limit > 0:
+            limiters.append(ratelimit.TokenBucket(self.rate_limit))
+        if self.global_bucket is not None:
+            limiters.append(self.global_bucket)
+        return limiters
+
+    def _watch(self, conn):
+        """
+        Pone una conexión admitida bajo la vigilancia del reaper.
+        """
+        if self.reaper is not None:
+            self.reaper.add(conn)
+
+    def stop(self):
+        """
+        Pide una detención ordenada: se deja de aceptar conexiones y se
+        espera (hasta SHUTDOWN_TIMEOUT segundos) a que terminen las activas.
+        """
+        self.stopping = True
+
+    def _on_signal(self, signum, frame):
+        self.stop()
+
+    def supervise(self):
+        """
+        Lanza self.processes procesos hijos que comparten el socket que
+        escucha (heredado con fork, así el kernel reparte las conexiones
+        entre ellos) y los vigila: si alguno termina inesperadamente se
+        lanza otro en su lugar. Con SIGTERM o SIGINT se les pide a todos
+        una detención ordenada y se espera que terminen.
+        """
+        children = {}
+
+        def shutdown(signum, frame):
+            self.stopping = True
+            for pid in children:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+        for slot in range(self.processes):
+            pid = self._spawn(slot)
+            children[pid] = (time.monotonic(), slot)
+
+        while children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            child = children.pop(pid, None)
+            if child is None or self.stopping:
+                continue
+            started, slot = child
+            print(f"El proceso {pid} terminó inesperadamente "
+                  f"(estado {status}), lanzando otro")
+            # Si el hijo murió apenas lanzado esperamos un poco, para no
+            # entrar en un ciclo de forks si falla siempre al arrancar.
+            if time.monotonic() - started < RESPAWN_BACKOFF:
+                time.sleep(RESPAWN_BACKOFF)
+            if not self.stopping:
+                pid = self._spawn(slot)
+                children[pid] = (time.monotonic(), slot)
+        self.sock.close()
+
+    def _spawn(self, slot):
+        """
+        Crea el proceso hijo número slot, que atiende conexiones con el
+        motor elegido. Devuelve el pid del hijo (el hijo nunca retorna).
+        """
+        pid = os.fork()
+        if pid != 0:
+            return pid
+        status = 0
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, self._on_signal)
+            self._serve_engine(None if self.metrics_port is None
+                               else self.metrics_port + slot)
+        except BaseException as e:
+            print(f"Error en el proceso {os.getpid()}: {e}")
+            status = 1
+        finally:
+            sys.stdout.flush()
+            os._exit(status)
+
+    def _drain(self):
+        """
+        Espera a que terminen las conexiones activas, como mucho
+        SHUTDOWN_TIMEOUT segundos.
+        """
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+        while self.active > 0 and time.monotonic() < deadline:
+            time.sleep(ACCEPT_POLL_INTERVAL)
+
+    def serve_threads(self):
+        """
+        Pone a escuchar al servidor por conexiones entrantes y las reparte
+        entre un conjunto fijo de hilos. Si los hilos y la cola de espera
+        están llenos, las conexiones nuevas se rechazan con SERVER_BUSY.
+
+        Los sockets de las conexiones no bloquean: un hilo sólo atiende una
+        conexión mientras tenga trabajo listo. Una que espera un comando,
+        que el cliente reciba lo ya enviado o que venza su límite de ancho
+        de banda queda en un ConnectionParking, y con quantum, una que agota
+        su turno vuelve al final de la cola.
+        """
+        self.lock = threading.Lock()
+        pending = queue.Queue()
+        self.parking = ConnectionParking(pending)
+        for _ in range(self.max_workers):
+            t = threading.Thread(target=self._worker, args=(pending,),
+                                 daemon=True)
             t.start() # Se inicia el hilo  
+        # El accept despierta periódicamente para ver si hay que detenerse.
+        self.sock.settimeout(ACCEPT_POLL_INTERVAL)
+        while not self.stopping:
+            try:
+                (clientsocket, address) = self.sock.accept()
+            except socket.timeout:
+                continue
+            logging.debug(f"Conectado por: {address}")
+            with self.lock:
+                admitted = self._admit(self.busy + pending.qsize())
+            if not admitted:
+                self._refuse(connection.Connection(clientsocket,
+                                                   self.directory,
+                                                   index=self.index))
+                continue
+            conn = connection.Connection(clientsocket, self.directory,
+                                         blocking=False, index=self.index,
+                                         cache=self.cache,
+                                         compress_level=self.compress_level,
+                                         limiters=self._limiters(),
+                                         quantum=self.quantum,
+                                         max_line=self.max_line,
+                                         files=self.files,
+                                         checksums=self.checksums)
+            self._watch(conn)
+            pending.put(conn)
+        self._drain()
+
+    def _worker(self, pending):
+        """
+        Hilo del pool: atiende, de a una, las conexiones de la cola. Una
+        conexión que no terminó vuelve a la cola o queda esperando lo que
+        necesita para seguir (ver _set_aside).
+        """
+        while True:
+            conn = pending.get()
+            with self.lock:
+                self.busy += 1
+            try:
+                done = conn.handle(park=True)
+                if not done:
+                    self._set_aside(conn, pending)
+            except Exception as e:
+                logging.exception("Error en el manejo de la conexión")
+                conn.drop_outgoing()
+                conn.close()
+                done = True
+            with self.lock:
+                self.busy -= 1
+                if done:
+                    self.active -= 1
+
+    def _set_aside(self, conn, pending):
+        """
+        Deja de lado una conexión que no puede seguir ahora, sin retener un
+        hilo: si espera un comando, que el socket acepte más datos o que
+        venza la espera de su límite de ancho de banda va al estacionamiento;
+        si espera una PendingReply, vuelve a la cola cuando termina de
+        calcularse, y si agotó su turno vuelve al final de la cola (round
+        robin entre las transferencias y las conexiones que esperan un
+        hilo).
+        """
+        if not conn.outgoing:
+            self.parking.park(conn)
+        elif conn.waiting_reply():
+            conn.outgoing[0].future.add_done_callback(
+                lambda _: pending.put(conn))
+        elif conn.resume_at > time.monotonic():
+            self.parking.delay(conn, conn.resume_at)
+        elif conn.quantum is not None and conn.deficit <= 0:
+            pending.put(conn)
+        else:
+            self.parking.park(conn, selectors.EVENT_WRITE)
+
+    def _admit(self, queued=None):
+        """
+        Control de admisión: cuenta una conexión más si no se llegó a
+        max_connections y, en el motor de hilos, si hay lugar entre los
+        hilos y la cola de espera (queued son las conexiones que ocupan o
+        esperan un hilo). Devuelve False si está saturado.
+        """
+        if self.max_connections and self.active >= self.max_connections:
+            return False
+        if queued is not None and \
+                queued >= self.max_workers + self.max_queued:
+            return False
+        self.active += 1
+        return True
+
+    def _refuse(self, conn):
+        """
+        Rechaza una conexión porque el servidor está saturado: informa
+        SERVER_BUSY (error fatal) y cierra.
+        """
+        logging.warning("Servidor saturado, conexión rechazada")
+        metrics.REGISTRY.inc("hftp_refused_connections_total")
+        conn.send_status(SERVER_BUSY)
+        conn.close()
+        conn.flush()
+
+    def serve_async(self):
+        """
+        Atiende todas las conexiones desde un único hilo con un selector:
+        los sockets son no bloqueantes, se lee de cada cliente cuando tiene
+        datos y se le escribe cuando puede recibir más. Las conexiones que
+        superaron su límite de ancho de banda salen del selector hasta que
+        puedan seguir enviando.
+        """
+        self.sock.setblocking(False)
+        sel = selectors.DefaultSelector()
+        sel.register(self.sock, selectors.EVENT_READ, None)
+        self.throttled = []  # heap de (resume_at, id, conexión)
+        # Las conexiones que esperan una PendingReply salen del selector;
+        # el hilo que la termina de calcular las anota en woken y despierta
+        # al event loop escribiendo en este pipe.
+        self.woken = []
+        self.woken_lock = threading.Lock()
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_r, False)
+        os.set_blocking(self.wakeup_w, False)
+        sel.register(self.wakeup_r, selectors.EVENT_READ, self.woken)
+        deadline = None
+        while deadline is None or (self.active > 0 and
+                                   time.monotonic() < deadline):
+            if self.stopping and deadline is None:
+                # Dejamos de aceptar y seguimos atendiendo a los activos.
+                sel.unregister(self.sock)
+                deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+            timeout = ACCEPT_POLL_INTERVAL
+            if self.throttled:
+                timeout = min(timeout, max(self.throttled[0][0] -
+                                           time.monotonic(), 0))
+            for key, mask in sel.select(timeout):
+                if key.data is None:
+                    self._accept_async(sel)
+                elif key.data is self.woken:
+                    self._resume_woken(sel)
+                else:
+                    self._service_async(sel, key.data, mask)
+            now = time.monotonic()
+            while self.throttled and self.throttled[0][0] <= now:
+                conn = heapq.heappop(self.throttled)[2]
+                sel.register(conn.socket, selectors.EVENT_WRITE, conn)
+
+    def _wake_async(self, conn):
+        """
+        Le avisa al event loop, desde otro hilo, que la PendingReply que
+        esperaba conn ya está lista.
+        """
+        with self.woken_lock:
+            self.woken.append(conn)
+        try:
+            os.write(self.wakeup_w, b"\0")
+        except BlockingIOError:
+            pass  # El pipe ya tiene avisos sin leer
+
+    def _resume_woken(self, sel):
+        """
+        Vuelve a registrar en el selector las conexiones despertadas por
+        _wake_async, para enviarles sus respuestas.
+        """
+        try:
+            while os.read(self.wakeup_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        with self.woken_lock:
+            woken = self.woken[:]
+            del self.woken[:]
+        for conn in woken:
+            if conn.socket.fileno() == -1:
+                continue
+            try:
+                sel.get_key(conn.socket)
+            except KeyError:
+                sel.register(conn.socket, selectors.EVENT_WRITE, conn)
+
+    def _accept_async(self, sel):
+        """
+        Acepta las conexiones pendientes y las registra en el selector.
+        """
+        while True:
+            try:
+                clientsocket, address = self.sock.accept()
+            except BlockingIOError:
+                return
+            logging.debug(f"Conectado por: {address}")
+            if not self._admit():
+                self._refuse(connection.Connection(clientsocket,
+                                                   self.directory,
+                                                   index=self.index))
+                continue
+            conn = connection.Connection(clientsocket, self.directory,
+                                         blocking=False, index=self.index,
+                                         cache=self.cache,
+                                         compress_level=self.compress_level,
+                                         limiters=self._limiters(),
+                                         quantum=self.quantum,
+                                         max_line=self.max_line,
+                                         files=self.files,
+                                         checksums=self.checksums)
+            conn.wakeup = self._wake_async
+            self._watch(conn)
+            sel.register(clientsocket, selectors.EVENT_READ, conn)
+
+    def _service_async(self, sel, conn, mask):
+        """
+        Procesa los eventos de una conexión y actualiza su registro en el
+        selector. Mientras tenga respuestas sin enviar no se le leen nuevos
+        comandos, para no acumular memoria con clientes lentos.
+        """
+        sock = conn.socket
+        try:
+            if mask & selectors.EVENT_READ and conn.connected:
+                conn.on_readable()
+            if conn.outgoing:
+                conn.flush()
+        except Exception as e:
+            logging.exception("Error en el manejo de la conexión")
+            conn.drop_outgoing()
+            conn.close()
+
+        if not conn.connected and not conn.outgoing:
+            sel.unregister(sock)
+            conn._close_socket()
+            self.active -= 1
+            return
+        if conn.waiting_reply():
+            sel.unregister(sock)  # vuelve con _resume_woken
+            return
+        if conn.outgoing and conn.resume_at > time.monotonic():
+            sel.unregister(sock)
+            heapq.heappush(self.throttled, (conn.resume_at, id(conn), conn))
+            return
+        events = selectors.EVENT_WRITE if conn.outgoing \
+            else selectors.EVENT_READ
+        if sel.get_key(sock).events != events:
+            sel.modify(sock, events, conn)
 
 
 def main():
@@ -69,6 +652,78 @@ def main():
     parser.add_option(
         "-d", "--datadir",
         help="Directorio compartido", default=DEFAULT_DIR)
+    parser.add_option(
+        "-e", "--engine", type="choice", choices=list(ENGINES),
+        help="Motor de atención de conexiones: %s" % ", ".join(ENGINES),
+        default=DEFAULT_ENGINE)
+    parser.add_option(
+        "--max-workers", type="int",
+        help="Cantidad de hilos que atienden conexiones",
+        default=DEFAULT_MAX_WORKERS)
+    parser.add_option(
+        "--max-queued", type="int",
+        help="Conexiones que pueden esperar un hilo libre antes de "
+        "rechazarse", default=DEFAULT_MAX_QUEUED)
+    parser.add_option(
+        "--max-connections", type="int",
+        help="Conexiones abiertas a la vez por proceso antes de rechazar "
+        "las nuevas (0: sin límite)", default=DEFAULT_MAX_CONNECTIONS)
+    parser.add_option(
+        "--listen-backlog", type="int",
+        help="Tamaño de la cola de conexiones pendientes del socket",
+        default=DEFAULT_LISTEN_BACKLOG)
+    parser.add_option(
+        "--processes", type="int",
+        help="Cantidad de procesos que atienden conexiones", default=1)
+    parser.add_option(
+        "--cache-size", type="int",
+        help="MiB del cache de bloques de archivos por proceso "
+        "(0 lo desactiva)", default=DEFAULT_CACHE_SIZE // 2**20)
+    parser.add_option(
+        "--open-files", type="int",
+        help="Archivos abiertos por proceso para leer los slices "
+        "(0 lo desactiva)", default=DEFAULT_OPEN_FILES)
+    parser.add_option(
+        "--checksum-workers", type="int",
+        help="Hilos por proceso que calculan las sumas de verificación "
+        "de los archivos grandes", default=DEFAULT_CHECKSUM_WORKERS)
+    parser.add_option(
+        "--compress-level", type="int",
+        help="Nivel de compresión (1-9) de los slices en modo zlib",
+        default=DEFAULT_COMPRESS_LEVEL)
+    parser.add_option(
+        "--rate-limit", type="int",
+        help="KiB/s de slices que puede recibir cada conexión "
+        "(0: sin límite)", default=DEFAULT_RATE_LIMIT // 2**10)
+    parser.add_option(
+        "--global-rate-limit", type="int",
+        help="KiB/s de slices entre todas las conexiones de cada proceso "
+        "(0: sin límite)", default=DEFAULT_GLOBAL_RATE_LIMIT // 2**10)
+    parser.add_option(
+        "--quantum", type="int",
+        help="KiB de slices que envía cada conexión por turno antes de "
+        "ceder el lugar a las demás (0: sin turnos)",
+        default=DEFAULT_QUANTUM // 2**10)
+    parser.add_option(
+        "--metrics-port", type="int",
+        help="Puerto donde servir las métricas por HTTP (GET /metrics); "
+        "con varios procesos, el hijo i-ésimo usa este puerto + i")
+    parser.add_option(
+        "--idle-timeout", type="float",
+        help="Segundos sin actividad tras los que se corta una conexión "
+        "(0: sin límite)", default=DEFAULT_IDLE_TIMEOUT)
+    parser.add_option(
+        "--read-timeout", type="float",
+        help="Segundos para completar una línea ya empezada (0: sin límite)",
+        default=DEFAULT_READ_TIMEOUT)
+    parser.add_option(
+        "--request-timeout", type="float",
+        help="Segundos para terminar de enviar la respuesta a un pedido "
+        "(0: sin límite)", default=DEFAULT_REQUEST_TIMEOUT)
+    parser.add_option(
+        "--max-line", type="int",
+        help="Largo máximo en bytes de una línea de pedido",
+        default=DEFAULT_MAX_LINE)
 
     options, args = parser.parse_args()
     if len(args) > 0:
@@ -84,7 +739,35 @@ def main():
         parser.print_help()
         sys.exit(1)
 
-    server = Server(options.address, port, options.datadir)
+    if options.max_workers < 1 or options.max_queued < 0 or \
+            options.max_connections < 0 or \
+            options.processes < 1 or options.cache_size < 0 or \
+            options.open_files < 0 or \
+            not 1 <= options.compress_level <= 9 or \
+            options.rate_limit < 0 or options.global_rate_limit < 0 or \
+            options.quantum < 0 or options.idle_timeout < 0 or \
+            options.read_timeout < 0 or options.request_timeout < 0 or \
+            options.max_line < 1 or options.checksum_workers < 1:
+        sys.stderr.write("--max-workers, --processes y --checksum-workers "
+                         "deben ser positivos, --max-queued, "
+                         "--max-connections, --cache-size, --open-files, "
+                         "--quantum, los límites de ancho de banda y de "
+                         "tiempo no negativos, --max-line positivo y "
+                         "--compress-level entre 1 y 9\n")
+        parser.print_help()
+        sys.exit(1)
+
+    server = Server(options.address, port, options.datadir, options.engine,
+                    options.max_workers, options.max_queued,
+                    options.listen_backlog, options.processes,
+                    options.cache_size * 2**20, options.compress_level,
+                    options.rate_limit * 2**10,
+                    options.global_rate_limit * 2**10,
+                    options.quantum * 2**10, options.metrics_port,
+                    options.idle_timeout, options.read_timeout,
+                    options.request_timeout, options.max_line,
+                    options.open_files, options.checksum_workers,
+                    options.max_connections)
     server.serve()
 
 